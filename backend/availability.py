@@ -0,0 +1,376 @@
+import time
+import threading
+import hashlib
+import base64
+from datetime import datetime, timedelta
+from busy import AEST, day_start_minutes
+
+SLOT_INTERVAL = 15  # Minutes between candidate start times
+
+# ⚡ COMPUTED RESULT CACHE ⚡
+# (start_date, end_date, duration, tier, earliest_bucket) -> (expiry, day_masks, cache_timestamp)
+_RESULT_CACHE = {}
+_GENERATION = 0  # Bumped on every invalidation so in-flight computations can't store stale results
+_CACHE_LOCK = threading.Lock()  # invalidate() runs on DB, refresh and webhook threads
+RESULT_CACHE_MAX_ENTRIES = 512  # Expired entries are pruned once we pass this
+
+
+# --- BUSY INTERVALS ---
+
+def merge_busy_intervals(occupied):
+    """
+    Merge busy intervals into sorted, non-overlapping ones.
+
+    Args:
+        occupied: Iterable of busy.Busy (bookings, blocks, Google)
+
+    Returns:
+        List of [start, end] epoch-minute pairs, sorted by start
+    """
+    merged = []
+    # Zero-length entries occupy no time (point_masks handles the slots they still block)
+    for start, end, _ in sorted(b for b in occupied if b.end > b.start):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+# --- QUARTER-HOUR BITMAPS ---
+# A day is 96 quarter-hour cells; bit i of a day mask is the slot starting at i * 15 minutes.
+# Whole ranges are rasterised into one Python int so intervals crossing midnight need no special case.
+
+CELLS_PER_DAY = 24 * 60 // SLOT_INTERVAL
+DAY_MASK = (1 << CELLS_PER_DAY) - 1
+
+def rasterise(busy, base, n_cells):
+    """
+    Mark every cell that a busy interval touches.
+
+    Args:
+        busy: Merged [start, end] epoch-minute intervals
+        base: Epoch minute of cell 0
+        n_cells: Number of cells in the mask
+
+    Returns:
+        Int mask with bit i set when cell i overlaps any busy interval
+    """
+    mask = 0
+    limit = base + n_cells * SLOT_INTERVAL
+    for start, end in busy:
+        if end <= base or start >= limit:
+            continue
+        first = (max(start, base) - base) // SLOT_INTERVAL
+        last = -(-(min(end, limit) - base) // SLOT_INTERVAL)  # Ceiling division
+        mask |= ((1 << (last - first)) - 1) << first
+    return mask
+
+def fit_starts(free, cells):
+    """
+    Shifted-AND a free mask so bit i survives only if cells i .. i + cells - 1 are all free.
+    Runs in O(log cells) big-int operations by doubling the span each step.
+    """
+    fit = free
+    span = 1
+    while span < cells:
+        step = min(span, cells - span)
+        fit &= fit >> step
+        span += step
+    return fit
+
+def point_masks(occupied, base, n_cells):
+    """
+    Zero-length busy entries (end == start) occupy no time, yet a slot strictly containing one
+    still counts as overlapping it. A point inside a cell blocks that cell; a point on a cell
+    edge only blocks slots that run across the edge.
+
+    Returns:
+        (cells, edges): cells to mark busy, and edges as bit i = the edge at the start of cell i
+    """
+    cells = edges = 0
+    for b in occupied:
+        if b.end != b.start or not base <= b.start < base + n_cells * SLOT_INTERVAL:
+            continue
+        cell, offset = divmod(b.start - base, SLOT_INTERVAL)
+        if offset:
+            cells |= 1 << cell
+        else:
+            edges |= 1 << cell
+    return cells, edges
+
+def spanning_starts(edges, cells):
+    """Start cells whose slot of `cells` cells runs across any marked edge (edges at i+1 .. i+cells-1)."""
+    mask = 0
+    for k in range(1, cells):
+        mask |= edges >> k
+    return mask
+
+def window_mask(num_days, start_hour, end_hour):
+    """Candidate start cells for the bookable hours, repeated for every day in the range."""
+    first = start_hour * 60 // SLOT_INTERVAL
+    last = end_hour * 60 // SLOT_INTERVAL
+    day = ((1 << (last - first)) - 1) << first
+    mask = 0
+    for d in range(num_days):
+        mask |= day << (d * CELLS_PER_DAY)
+    return mask
+
+
+# --- SLOT ENGINE ---
+
+MAX_DURATIONS = 6  # Cap on durations per request (the modal offers 15/30/60)
+MAX_RANGE_DAYS = 60  # Cap on one /api/availability date range (the modal asks for about a week)
+
+def is_valid_duration(minutes):
+    """
+    Durations must be whole slots: the bitmap treats any cell a busy interval touches as
+    busy, so e.g. a 20-minute meeting would be judged as if it were 30 minutes long.
+    """
+    return 0 < minutes <= 24 * 60 and minutes % SLOT_INTERVAL == 0
+
+def parse_durations(raw):
+    """
+    Parse a duration query value like "30" or "15,30,60" into unique minute counts.
+
+    Raises:
+        ValueError: If any value is not a positive multiple of SLOT_INTERVAL up to a day
+    """
+    durations = []
+    for part in str(raw).split(","):
+        value = int(part.strip())
+        if not is_valid_duration(value):
+            raise ValueError(f"Invalid duration: {value}")
+        if value not in durations:
+            durations.append(value)
+    if not durations or len(durations) > MAX_DURATIONS:
+        raise ValueError("Expected between 1 and %d durations" % MAX_DURATIONS)
+    return durations
+
+def compute_day_masks_multi(start_date, end_date, durations, hours, earliest_booking_time, occupied):
+    """
+    Rasterise all busy time for the range once and fit every requested duration against it.
+
+    Args:
+        start_date: Start date (YYYY-MM-DD)
+        end_date: End date (YYYY-MM-DD)
+        durations: Meeting durations in minutes
+        hours: {"start": H, "end": H} bookable window for the tier
+        earliest_booking_time: Aware datetime; slots must start strictly after it
+        occupied: List of busy.Busy intervals
+
+    Returns:
+        Dict of {duration: {date: 96-bit int}} where each set bit is a valid start slot
+    """
+    first_day = datetime.strptime(start_date, "%Y-%m-%d")
+    num_days = (datetime.strptime(end_date, "%Y-%m-%d") - first_day).days + 1
+    if num_days <= 0:
+        return {duration: {} for duration in durations}
+
+    cells_for = {duration: max(1, -(-duration // SLOT_INTERVAL)) for duration in durations}
+    base = day_start_minutes(start_date)
+    # Extra tail cells let a late slot run past midnight on the last day
+    n_cells = num_days * CELLS_PER_DAY + max(cells_for.values())
+
+    points, edges = point_masks(occupied, base, n_cells)
+    busy = rasterise(merge_busy_intervals(occupied), base, n_cells) | points
+    free = ~busy & ((1 << n_cells) - 1)
+    candidates = window_mask(num_days, hours['start'], hours['end'])
+
+    # Time barrier: drop every cell at or before the earliest bookable moment
+    cutoff = int((earliest_booking_time.timestamp() / 60 - base) // SLOT_INTERVAL) + 1
+    if cutoff > 0:
+        candidates &= ~((1 << cutoff) - 1)
+
+    dates = [(first_day + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(num_days)]
+    results = {}
+    for duration, cells in cells_for.items():
+        valid = fit_starts(free, cells) & candidates
+        if edges:
+            valid &= ~spanning_starts(edges, cells)
+        results[duration] = {
+            date_str: (valid >> (d * CELLS_PER_DAY)) & DAY_MASK for d, date_str in enumerate(dates)
+        }
+    return results
+
+def compute_day_masks(start_date, end_date, duration, hours, earliest_booking_time, occupied):
+    """Single-duration form of compute_day_masks_multi: {date: 96-bit int}."""
+    return compute_day_masks_multi(
+        start_date, end_date, [duration], hours, earliest_booking_time, occupied
+    )[duration]
+
+def mask_to_iso(date_str, mask):
+    """Expand a day mask into the ISO-8601 slot strings the frontend expects."""
+    offset = utc_offset(date_str)
+    slots = []
+    while mask:
+        low = mask & -mask
+        mins = (low.bit_length() - 1) * SLOT_INTERVAL
+        slots.append(f"{date_str}T{mins // 60:02d}:{mins % 60:02d}:00{offset}")
+        mask ^= low
+    return slots
+
+def masks_to_iso(masks):
+    """{date: mask} -> {date: [iso, ...]}"""
+    return {date_str: mask_to_iso(date_str, mask) for date_str, mask in masks.items()}
+
+# --- RESPONSE FORMATS ---
+
+SLOT_FORMATS = ("iso", "compact", "bitmap")
+
+def mask_to_runs(mask):
+    """
+    Collapse a day mask into [start_minute, slot_count] runs of consecutive valid starts.
+    e.g. 09:00-09:45 all free at 15-minute steps -> [[540, 4]]
+    """
+    runs = []
+    while mask:
+        low = mask & -mask
+        start = low.bit_length() - 1
+        # Adding the lowest set bit carries through the run and lands on the bit just above it
+        above = (mask + low) & ~mask
+        length = above.bit_length() - 1 - start
+        runs.append([start * SLOT_INTERVAL, length])
+        mask &= ~(above - low)
+    return runs
+
+def mask_to_bitmap(mask):
+    """Base64 of the 96-bit day mask, little-endian (bit i = slot at i * 15 minutes)."""
+    return base64.b64encode(mask.to_bytes(CELLS_PER_DAY // 8, "little")).decode()
+
+def format_day_masks(masks, slot_format):
+    """{date: mask} -> {date: slots} in the requested response format."""
+    if slot_format == "compact":
+        return {date_str: mask_to_runs(mask) for date_str, mask in masks.items()}
+    if slot_format == "bitmap":
+        return {date_str: mask_to_bitmap(mask) for date_str, mask in masks.items()}
+    return masks_to_iso(masks)
+
+def utc_offset(date_str):
+    """Local UTC offset for a date, e.g. "+10:00"."""
+    return AEST.localize(datetime.strptime(date_str, "%Y-%m-%d")).isoformat()[19:]
+
+
+# --- FORWARD SEARCH ---
+
+NEXT_SEARCH_WINDOWS = (7, 14, 28)  # Days fetched per step; the last size repeats
+MAX_SEARCH_DAYS = 60
+
+def find_next_slots(count, duration, hours, earliest_booking_time, fetch_occupied, include_weekends=True):
+    """
+    Walk forward from the earliest bookable day until `count` free slots are found.
+
+    Busy data is fetched in growing windows so a quiet calendar costs one small fetch
+    while a packed one still terminates within MAX_SEARCH_DAYS.
+
+    Args:
+        count: Number of slots wanted
+        duration: Meeting duration in minutes
+        hours: {"start": H, "end": H} bookable window for the tier
+        earliest_booking_time: Aware datetime; slots must start strictly after it
+        fetch_occupied: Callable(start_date, end_date) -> list of busy.Busy
+        include_weekends: Public visitors only ever see weekdays
+
+    Returns:
+        (slots, last_date_searched) where slots is a list of ISO strings in time order
+    """
+    first_day = earliest_booking_time.astimezone(AEST).replace(tzinfo=None)
+    first_day = first_day.replace(hour=0, minute=0, second=0, microsecond=0)
+    slots = []
+    searched = 0
+    step = 0
+
+    while searched < MAX_SEARCH_DAYS:
+        window = NEXT_SEARCH_WINDOWS[min(step, len(NEXT_SEARCH_WINDOWS) - 1)]
+        window = min(window, MAX_SEARCH_DAYS - searched)
+        window_start = (first_day + timedelta(days=searched)).strftime("%Y-%m-%d")
+        window_end = (first_day + timedelta(days=searched + window - 1)).strftime("%Y-%m-%d")
+
+        masks = compute_day_masks(
+            window_start, window_end, duration, hours, earliest_booking_time,
+            fetch_occupied(window_start, window_end)
+        )
+        for date_str, mask in masks.items():  # Insertion order is day order
+            if not include_weekends and datetime.strptime(date_str, "%Y-%m-%d").weekday() >= 5:
+                continue
+            for slot in mask_to_iso(date_str, mask):
+                slots.append(slot)
+                if len(slots) == count:
+                    return slots, date_str
+
+        searched += window
+        step += 1
+
+    return slots, (first_day + timedelta(days=searched - 1)).strftime("%Y-%m-%d")
+
+# --- RESULT CACHE ---
+
+def earliest_bucket(earliest_booking_time):
+    """
+    Quarter-hour bucket of the notice cutoff. Results only change when the cutoff
+    crosses a slot boundary, so every request inside one bucket can share an entry.
+    """
+    return int(earliest_booking_time.timestamp() // 60 // SLOT_INTERVAL)
+
+def result_cache_key(start_date, end_date, duration, tier, bucket):
+    return (start_date, end_date, duration, tier, bucket)
+
+def get_cached_result(key):
+    """Return (day_masks, cache_timestamp) for a live entry, or None."""
+    with _CACHE_LOCK:
+        entry = _RESULT_CACHE.get(key)
+    if entry and time.time() < entry[0]:
+        return entry[1], entry[2]
+    return None
+
+def current_generation():
+    with _CACHE_LOCK:
+        return _GENERATION
+
+def cache_result(key, day_masks, cache_timestamp, ttl, generation):
+    """Store a computed result unless the data it was built from has since been invalidated."""
+    if ttl <= 0:
+        return
+    with _CACHE_LOCK:
+        if generation != _GENERATION:
+            return
+        if len(_RESULT_CACHE) >= RESULT_CACHE_MAX_ENTRIES:
+            now = time.time()
+            for stale_key in [k for k, v in _RESULT_CACHE.items() if v[0] <= now]:
+                del _RESULT_CACHE[stale_key]
+            if len(_RESULT_CACHE) >= RESULT_CACHE_MAX_ENTRIES:
+                _RESULT_CACHE.clear()
+        _RESULT_CACHE[key] = (time.time() + ttl, day_masks, cache_timestamp)
+
+def invalidate():
+    """Drop every computed result. Called whenever bookings, blocks or calendar data change."""
+    global _GENERATION
+    with _CACHE_LOCK:
+        _GENERATION += 1
+        _RESULT_CACHE.clear()
+
+
+# --- ETAGS ---
+
+def availability_etag(results, start_date, end_date, slot_format="iso"):
+    """
+    Strong ETag for an availability response, hashed from the computed day masks
+    ({duration: {date: mask}}) so it changes exactly when the offered slots do.
+    """
+    digest = hashlib.sha1(f"{start_date}|{end_date}|{slot_format}".encode())
+    for duration in results:  # Request order: "slots" mirrors the first duration
+        digest.update(f"|{duration}:".encode())
+        for date_str, mask in sorted(results[duration].items()):
+            digest.update(f"{date_str}={mask:x};".encode())
+    return '"' + digest.hexdigest()[:24] + '"'
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check: handles '*', lists, and W/ prefixes (weak comparison per RFC 9110)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
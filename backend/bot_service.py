@@ -37,9 +37,9 @@ class BookingView(View):
         try:
             print(f"🔄 Processing acceptance for {self.booking_id}...")
 
-            # 2. Database Update
-            database.update_booking_status(self.booking_id, "ACCEPTED")
-            booking = database.get_booking(self.booking_id)
+            # 2. Database Update (on the DB thread, never on the bot's event loop)
+            await database.run_async(database.update_booking_status, self.booking_id, "ACCEPTED")
+            booking = await database.run_async(database.get_booking, self.booking_id)
             
             if not booking:
                 await interaction.followup.send("❌ Error: Booking lost.", ephemeral=True)
@@ -96,8 +96,8 @@ class BookingView(View):
         
         try:
             print(f"🔄 Rejecting booking {self.booking_id}...")
-            database.update_booking_status(self.booking_id, "REJECTED")
-            booking = database.get_booking(self.booking_id)
+            await database.run_async(database.update_booking_status, self.booking_id, "REJECTED")
+            booking = await database.run_async(database.get_booking, self.booking_id)
             
             # Update the message immediately to show "REJECTED"
             await interaction.message.edit(content=f"❌ **REJECTED** by {interaction.user.name}", view=None)
@@ -115,7 +115,7 @@ class BookingView(View):
         await interaction.response.defer()
         try:
             print(f"🧹 Cancelling booking {self.booking_id}...")
-            booking = database.get_booking(self.booking_id)
+            booking = await database.run_async(database.get_booking, self.booking_id)
             if not booking:
                 await interaction.followup.send("❌ Error: Booking lost.", ephemeral=True)
                 return
@@ -123,12 +123,12 @@ class BookingView(View):
                 await interaction.followup.send("⚠️ Only accepted bookings can be cancelled.", ephemeral=True)
                 return
 
-            database.update_booking_status(self.booking_id, "CANCELLED")
+            await database.run_async(database.update_booking_status, self.booking_id, "CANCELLED")
 
             # Remove from Google Calendar if it exists
             if booking.get('google_event_id'):
                 import gcal
-                gcal.delete_google_event(booking['google_event_id'])
+                await asyncio.to_thread(gcal.delete_google_event, booking['google_event_id'])
 
             # Notify user via email (background)
             await asyncio.to_thread(
@@ -155,7 +155,7 @@ class BanView(View):
     async def unban_button(self, interaction: discord.Interaction, button: Button):
         await interaction.response.defer()
         try:
-            database.unban_ip(self.ip_address)
+            await database.run_async(database.unban_ip, self.ip_address)
             await self._disable_buttons()
             await interaction.message.edit(content=f"✅ **UNBANNED** {self.ip_address} by {interaction.user.name}", view=self)
         except Exception as e:
@@ -0,0 +1,37 @@
+import pytz
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+AEST = pytz.timezone('Australia/Brisbane')
+
+
+class Busy(NamedTuple):
+    """
+    A stretch of unavailable time as [start, end) epoch minutes.
+    Built once where the data is read (database, gcal) and used as-is by the availability engine.
+    """
+    start: int
+    end: int
+    source: str = "LOCAL"
+
+
+@lru_cache(maxsize=512)
+def day_start_minutes(date_str):
+    """Epoch minute of local midnight for a YYYY-MM-DD date."""
+    day = AEST.localize(datetime.strptime(date_str, "%Y-%m-%d"))
+    return int(day.timestamp()) // 60
+
+def to_epoch_minutes(date_str, time_str):
+    """Epoch minute for a local date ('YYYY-MM-DD') and time ('HH:MM')."""
+    hours, minutes = time_str.split(":")[:2]
+    return day_start_minutes(date_str) + int(hours) * 60 + int(minutes)
+
+def from_local(date_str, time_str, duration, source="LOCAL"):
+    """Busy interval for a local date/time plus a duration in minutes."""
+    start = to_epoch_minutes(date_str, time_str)
+    return Busy(start, start + int(duration), source)
+
+def from_datetimes(start_dt, end_dt, source="LOCAL"):
+    """Busy interval covering two aware datetimes, widened to whole minutes."""
+    return Busy(int(start_dt.timestamp() // 60), -int(-end_dt.timestamp() // 60), source)
@@ -1,5 +1,12 @@
 import sqlite3
 import os
+import base64
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import availability
+import busy
 from datetime import datetime, timedelta
 
 # --- PERSISTENCE SETUP ---
@@ -21,11 +28,55 @@ else:
 db_dir = os.path.dirname(DB_NAME)
 os.makedirs(db_dir, exist_ok=True)
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    cursor = conn.cursor()
-    
+# --- CONNECTIONS ---
+# One long-lived connection per thread, configured once, instead of connect + PRAGMA per query.
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 8 * 1024          # Page cache per connection
+MMAP_SIZE = 64 * 1024 * 1024       # Reads straight from the OS page cache
+_LOCAL = threading.local()
+
+def get_connection():
+    """
+    The calling thread's connection (WAL, synchronous=NORMAL). Callers commit their own writes
+    and never close it. Don't call another database function while holding an uncommitted write.
+    """
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _LOCAL.conn = conn
+    elif conn.in_transaction:
+        conn.rollback()  # Left open by a call that raised; don't let it hold the write lock
+    return conn
+
+# --- ASYNC ACCESS ---
+# Async callers (FastAPI async endpoints, the Discord bot) hand queries to one dedicated DB
+# thread, so SQLite I/O and lock waits never stall the event loop. One thread also means one
+# reused connection and writes that queue up instead of contending for the write lock.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+async def run_async(func, *args, **kwargs):
+    """Await a database.* function on the DB thread, e.g. await run_async(get_booking, 5)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# --- SCHEMA MIGRATIONS ---
+# Each migration runs once, in order, inside its own transaction; PRAGMA user_version records
+# the last one applied. Never edit a released migration: append a new one.
+
+def _add_column(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        print(f"✅ MIGRATION: Added '{column}' column to {table}")
+
+def _migration_1_baseline(cursor):
+    """Every table, plus the columns older databases got from patchdb.py / patch_db_v2.py."""
     # 1. Bookings Table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS bookings (
@@ -64,120 +115,268 @@ def init_db():
         )
     ''')
 
-    # --- AUTO-MIGRATION (THE FIX) ---
-    # This block runs every time. It tries to add the column. 
-    # If the column exists, it ignores the error.
-    try:
-        cursor.execute("ALTER TABLE bookings ADD COLUMN google_event_id TEXT")
-        print("✅ MIGRATION SUCCESS: Added 'google_event_id' column")
-    except sqlite3.OperationalError:
-        # This error means the column likely already exists, which is fine.
-        pass
-    # --------------------------------
+    # 4. Google Calendar snapshot (lets a restart serve availability before Google answers)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gcal_events (
+            calendar_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            start_minute INTEGER NOT NULL,
+            end_minute INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (calendar_id, event_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gcal_sync_state (
+            calendar_id TEXT PRIMARY KEY,
+            sync_token TEXT,
+            window_start TEXT NOT NULL,
+            window_end TEXT NOT NULL,
+            synced_at REAL NOT NULL
+        )
+    ''')
 
-    conn.commit()
-    conn.close()
+    # 5. Google Calendar webhook channels (reused across restarts until they expire)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_channels (
+            channel_id TEXT PRIMARY KEY,
+            resource_id TEXT,
+            calendar_id TEXT NOT NULL,
+            expiration INTEGER NOT NULL,
+            created_at TEXT
+        )
+    ''')
+
+    # Databases created before these columns were part of CREATE TABLE
+    _add_column(cursor, "bookings", "location_type", "TEXT DEFAULT 'ONLINE'")
+    _add_column(cursor, "bookings", "location_details", "TEXT DEFAULT ''")
+    _add_column(cursor, "bookings", "google_event_id", "TEXT")
+
+def _migration_2_hot_query_indexes(cursor):
+    """Covering indexes so availability and spam checks never scan whole tables."""
+    # get_bookings_for_range: date range + status filter, reads time/duration
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_date_status ON bookings (date, status, time, duration)")
+    # check_spam_stats: counts per email + status, rejected ones since a created_at
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_email_status ON bookings (email, status, created_at)")
+    # get_blocks_for_range: date range, reads start/end
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_blocks_date ON blocks (date, start_time, end_time)")
+
+def _migration_3_bookings_keyset_index(cursor):
+    """Admin listing pages through bookings in (date, time, id) order; rowid rides along free."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_date_time ON bookings (date, time)")
+
+MIGRATIONS = [
+    _migration_1_baseline,
+    _migration_2_hot_query_indexes,
+    _migration_3_bookings_keyset_index,
+]
+
+def init_db():
+    """Bring the database up to the latest schema version (safe to run on every startup)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        # IMMEDIATE takes the write lock first, so two workers starting together can't both migrate
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+            print(f"✅ MIGRATION SUCCESS: Schema v{version} ({migration.__name__})")
+        except Exception:
+            conn.rollback()
+            raise
+    cursor.execute("PRAGMA optimize")
 
 # --- BOOKING FUNCTIONS ---
+ACTIVE_BOOKING_FILTER = "status NOT IN ('REJECTED', 'CANCELLED')"
+
 def add_booking(name, email, topic, date, time, duration, location_type, location_details):
-    conn = sqlite3.connect(DB_NAME)
+    """
+    Book a slot atomically: the overlap check and the insert share one BEGIN IMMEDIATE
+    transaction, so two concurrent requests can never both take the same time.
+
+    Returns:
+        The new booking ID, or None if the slot overlaps an active booking or a block
+    """
+    wanted = busy.from_local(date, time, duration)
+    # Neighbouring days too: bookings can run past midnight in either direction
+    day = datetime.strptime(date, "%Y-%m-%d")
+    first_day = (day - timedelta(days=1)).strftime("%Y-%m-%d")
+    last_day = (day + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    conn = get_connection()
     cursor = conn.cursor()
-    created_at = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT INTO bookings 
-        (name, email, topic, date, time, duration, location_type, location_details, created_at) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (name, email, topic, date, time, duration, location_type, location_details, created_at))
-    conn.commit()
-    conn.close()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # Both reads are covering-index searches (idx_bookings_date_status, idx_blocks_date)
+        cursor.execute(f"SELECT date, time, duration FROM bookings WHERE date >= ? AND date <= ? AND {ACTIVE_BOOKING_FILTER}", (first_day, last_day))
+        taken = [busy.from_local(r[0], r[1], r[2]) for r in cursor.fetchall()]
+        cursor.execute("SELECT date, start_time, end_time FROM blocks WHERE date >= ? AND date <= ?", (first_day, last_day))
+        taken += [busy.Busy(busy.to_epoch_minutes(r[0], r[1]), busy.to_epoch_minutes(r[0], r[2])) for r in cursor.fetchall()]
+        if any(b.start < wanted.end and b.end > wanted.start for b in taken):
+            conn.rollback()
+            return None
+
+        created_at = datetime.now().isoformat()
+        cursor.execute('''
+            INSERT INTO bookings 
+            (name, email, topic, date, time, duration, location_type, location_details, created_at) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, email, topic, date, time, duration, location_type, location_details, created_at))
+        booking_id = cursor.lastrowid
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    availability.invalidate()
+    return booking_id
 
 def get_bookings_for_range(start_date, end_date):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT date, time, duration FROM bookings WHERE date >= ? AND date <= ? AND status NOT IN ('REJECTED', 'CANCELLED')", (start_date, end_date))
+    cursor.execute(f"SELECT date, time, duration FROM bookings WHERE date >= ? AND date <= ? AND {ACTIVE_BOOKING_FILTER}", (start_date, end_date))
     rows = cursor.fetchall()
-    conn.close()
-    return [{"date": r[0], "time": r[1], "duration": r[2]} for r in rows]
+    return [busy.from_local(r[0], r[1], r[2], "BOOKING") for r in rows]
 
 def get_booking(booking_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
     cursor.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,))
     r = cursor.fetchone()
-    conn.close()
     if r: return dict(r)
     return None
 
 def update_booking_status(booking_id, new_status):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('UPDATE bookings SET status = ? WHERE id = ?', (new_status, booking_id))
     conn.commit()
-    conn.close()
+    availability.invalidate()
+
+BOOKING_COLUMNS = (
+    "id", "name", "email", "topic", "date", "time", "duration", "status",
+    "created_at", "location_type", "location_details", "google_event_id",
+)
+BOOKING_STATUSES = ("PENDING", "ACCEPTED", "REJECTED", "CANCELLED")
 
-def get_all_bookings():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+def encode_cursor(row):
+    """Opaque keyset cursor for the (date, time, id) of a listed booking."""
+    return base64.urlsafe_b64encode(f"{row['date']}|{row['time']}|{row['id']}".encode()).decode()
+
+def decode_cursor(cursor):
+    """(date, time, id) from encode_cursor; raises ValueError if it's malformed."""
+    try:
+        date, time, booking_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return date, time, int(booking_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def list_bookings(statuses=None, date_from=None, date_to=None, after=None, limit=100, columns=None, descending=False):
+    """
+    One page of bookings in (date, time, id) order, read through idx_bookings_date_time.
+
+    Args:
+        statuses: Only these statuses (None = any)
+        date_from / date_to: Inclusive YYYY-MM-DD bounds (None = open)
+        after: (date, time, id) of the last row of the previous page
+        columns: Columns to return (None = all); id, date and time are always included
+        descending: Newest first instead of oldest first
+
+    Returns:
+        (rows, has_more)
+    """
+    columns = list(columns or BOOKING_COLUMNS)
+    if any(c not in BOOKING_COLUMNS for c in columns):
+        raise ValueError("Invalid column")
+    if statuses and any(s not in BOOKING_STATUSES for s in statuses):
+        raise ValueError("Invalid status")
+    for key in ("id", "date", "time"):
+        if key not in columns:
+            columns.append(key)
+
+    where = []
+    params = []
+    if statuses:
+        where.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    if date_from:
+        where.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("date <= ?")
+        params.append(date_to)
+    if after:
+        where.append(f"(date, time, id) {'<' if descending else '>'} (?, ?, ?)")
+        params.extend(after)
+    direction = "DESC" if descending else "ASC"
+
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM bookings ORDER BY date DESC, time ASC')
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    cursor.row_factory = sqlite3.Row
+    cursor.execute(
+        f"SELECT {', '.join(columns)} FROM bookings"
+        + (f" WHERE {' AND '.join(where)}" if where else "")
+        + f" ORDER BY date {direction}, time {direction}, id {direction} LIMIT ?",
+        params + [limit + 1]
+    )
+    rows = [dict(row) for row in cursor.fetchall()]
+    return rows[:limit], len(rows) > limit
 
 # --- BLOCKING FUNCTIONS ---
 def add_block(date, start_time, end_time, reason):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('INSERT INTO blocks (date, start_time, end_time, reason) VALUES (?, ?, ?, ?)', (date, start_time, end_time, reason))
     conn.commit()
-    conn.close()
+    availability.invalidate()
 
 def get_all_blocks():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM blocks ORDER BY date DESC, start_time ASC')
     rows = cursor.fetchall()
-    conn.close()
     return [{"id": r[0], "date": r[1], "start_time": r[2], "end_time": r[3], "reason": r[4]} for r in rows]
 
 def delete_block(block_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
     conn.commit()
-    conn.close()
+    availability.invalidate()
 
 def get_blocks_for_range(start_date, end_date):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT date, start_time, end_time FROM blocks WHERE date >= ? AND date <= ?", (start_date, end_date))
     rows = cursor.fetchall()
-    conn.close()
-    normalized_blocks = []
-    for r in rows:
-        fmt = "%H:%M"
-        t1 = datetime.strptime(r[1], fmt)
-        t2 = datetime.strptime(r[2], fmt)
-        duration_mins = int((t2 - t1).total_seconds() / 60)
-        normalized_blocks.append({"date": r[0], "time": r[1], "duration": duration_mins})
-    return normalized_blocks
+    return [
+        busy.Busy(busy.to_epoch_minutes(r[0], r[1]), busy.to_epoch_minutes(r[0], r[2]), "BLOCK")
+        for r in rows
+    ]
+
+def get_local_busy_for_range(start_date, end_date):
+    """Bookings + blocks for a range in one call, so async callers hold a single DB-thread slot."""
+    return get_bookings_for_range(start_date, end_date) + get_blocks_for_range(start_date, end_date)
 
 # --- SECURITY FUNCTIONS ---
 
 def check_spam_stats(email):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM bookings WHERE email = ? AND status = 'PENDING'", (email,))
     pending_count = cursor.fetchone()[0]
     yesterday = (datetime.now() - timedelta(days=1)).isoformat()
     cursor.execute("SELECT COUNT(*) FROM bookings WHERE email = ? AND status = 'REJECTED' AND created_at > ?", (email, yesterday))
     rejected_count = cursor.fetchone()[0]
-    conn.close()
     return {"pending": pending_count, "rejected": rejected_count}
 
 def ban_ip(ip, reason, duration_minutes):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     expires_at = (datetime.now() + timedelta(minutes=duration_minutes)).isoformat()
     cursor.execute('''
@@ -185,14 +384,12 @@ def ban_ip(ip, reason, duration_minutes):
         ON CONFLICT(ip) DO UPDATE SET expires_at=excluded.expires_at, reason=excluded.reason
     ''', (ip, reason, expires_at))
     conn.commit()
-    conn.close()
 
 def is_ip_banned(ip):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT expires_at FROM banned_ips WHERE ip = ?", (ip,))
     row = cursor.fetchone()
-    conn.close()
     if row:
         expires_at = datetime.fromisoformat(row[0])
         if datetime.now() < expires_at:
@@ -202,26 +399,99 @@ def is_ip_banned(ip):
     return False
 
 def unban_ip(ip):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM banned_ips WHERE ip = ?", (ip,))
     conn.commit()
-    conn.close()
 
 def wipe_troll_requests(email):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM bookings WHERE email = ?", (email,))
     deleted_count = cursor.rowcount
     conn.commit()
-    conn.close()
+    if deleted_count:
+        availability.invalidate()
     return deleted_count
 
 # --- GOOGLE EVENT ID HELPER ---
 def update_google_event_id(booking_id, event_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     # If this still fails, the migration above didn't run, but it should!
     cursor.execute('UPDATE bookings SET google_event_id = ? WHERE id = ?', (event_id, booking_id))
     conn.commit()
-    conn.close()
\ No newline at end of file
+
+# --- GOOGLE CALENDAR SNAPSHOT ---
+def save_calendar_snapshot(calendar_id, events, sync_token, window, synced_at, events_changed=True):
+    """
+    Persist one calendar's synced event store and sync token.
+
+    Args:
+        events: {event_id: busy.Busy} for the whole sync window
+        window: (first_day, last_day) the events and token cover
+        events_changed: False to only bump the token/timestamp (skips rewriting every event)
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    if events_changed:
+        cursor.execute("DELETE FROM gcal_events WHERE calendar_id = ?", (calendar_id,))
+        cursor.executemany(
+            "INSERT INTO gcal_events (calendar_id, event_id, start_minute, end_minute, source) VALUES (?, ?, ?, ?, ?)",
+            [(calendar_id, event_id, b.start, b.end, b.source) for event_id, b in events.items()]
+        )
+    cursor.execute('''
+        INSERT INTO gcal_sync_state (calendar_id, sync_token, window_start, window_end, synced_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(calendar_id) DO UPDATE SET sync_token=excluded.sync_token, window_start=excluded.window_start,
+            window_end=excluded.window_end, synced_at=excluded.synced_at
+    ''', (calendar_id, sync_token, window[0], window[1], synced_at))
+    conn.commit()
+
+def load_calendar_snapshots():
+    """Every persisted calendar as {calendar_id: {"events", "token", "window", "synced_at"}}."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT calendar_id, sync_token, window_start, window_end, synced_at FROM gcal_sync_state")
+    snapshots = {
+        r[0]: {"events": {}, "token": r[1], "window": (r[2], r[3]), "synced_at": r[4]}
+        for r in cursor.fetchall()
+    }
+    cursor.execute("SELECT calendar_id, event_id, start_minute, end_minute, source FROM gcal_events")
+    for r in cursor.fetchall():
+        if r[0] in snapshots:
+            snapshots[r[0]]["events"][r[1]] = busy.Busy(r[2], r[3], r[4])
+    return snapshots
+
+# --- WEBHOOK CHANNELS ---
+def save_webhook_channel(channel):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO webhook_channels (channel_id, resource_id, calendar_id, expiration, created_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET resource_id=excluded.resource_id, calendar_id=excluded.calendar_id,
+            expiration=excluded.expiration
+    ''', (channel['channel_id'], channel.get('resource_id'), channel['calendar_id'], channel['expiration'], channel.get('created_at')))
+    conn.commit()
+
+def get_webhook_channels():
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute('SELECT * FROM webhook_channels ORDER BY expiration DESC')
+    rows = cursor.fetchall()
+    return [dict(row) for row in rows]
+
+def get_webhook_channel(channel_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute('SELECT * FROM webhook_channels WHERE channel_id = ?', (channel_id,))
+    r = cursor.fetchone()
+    if r: return dict(r)
+    return None
+
+def delete_webhook_channel(channel_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM webhook_channels WHERE channel_id = ?', (channel_id,))
+    conn.commit()
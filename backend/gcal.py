@@ -1,14 +1,24 @@
 import os
 import os.path
+import re
+import hmac
+import hashlib
 import time
 import pytz
 import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import availability
+import busy
+import database
 
 # --- CONFIG & CACHE SETUP ---
 if os.path.exists('.env'):
@@ -28,29 +38,179 @@ BUFFER_COLOR_IDS = os.getenv("BUFFER_COLOR_IDS", "").split(",")
 # Webhook configuration
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # e.g., https://your-backend.railway.app/api/calendar/webhook
 
-# ⚡ THE CACHE STORAGE ⚡
-_CALENDAR_CACHE = {}
-_CACHE_TIMESTAMP = {}  # Track when each cache entry was created
 CACHE_DURATION = 30  # Reduced to 30 seconds for faster updates
+BUFFER_MINUTES = 60  # Padding added around buffered (work/class) events
+# Stale-while-revalidate: an expired day is still served for this long while one background
+# refresh runs; only days older than this (or never fetched) make a visitor wait on Google.
+STALE_WHILE_REVALIDATE = int(os.getenv("GCAL_STALE_SECONDS", "600"))
+
+class DayCache:
+    """
+    Bounded LRU of per-day busy times. Capped both by day count and by the total number of
+    intervals held (a proxy for memory); days past their stale grace are swept out, and the
+    least recently used days go first when either cap is hit. Safe to share across threads.
+    """
+
+    def __init__(self, max_days, max_intervals):
+        self.max_days = max_days
+        self.max_intervals = max_intervals
+        self._entries = OrderedDict()  # (calendar_id, 'YYYY-MM-DD') -> (expiry, [Busy, ...], fetched_at)
+        self._intervals = 0
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+        self.hits = self.stale_hits = self.misses = self.evictions = self.expirations = 0
+
+    def lookup(self, key, now):
+        """Counted read for freshness checks: returns (expiry, busy) or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry[0] + STALE_WHILE_REVALIDATE:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if now >= entry[0]:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return entry[0], entry[1]
+
+    def get(self, key):
+        """Uncounted read: (expiry, busy, fetched_at) or None."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, expiry, busy_times, fetched_at):
+        """Store a day; returns the busy times it replaced (None if the day wasn't cached)."""
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self._intervals -= len(previous[1])
+            self._entries[key] = (expiry, busy_times, fetched_at)
+            self._intervals += len(busy_times)
+            self._sweep(time.time())
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_days or self._intervals > self.max_intervals
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._intervals -= len(evicted[1])
+                self.evictions += 1
+            return previous[1] if previous else None
+
+    def _sweep(self, now):
+        # Dead entries are rare between sweeps, so a full pass every CACHE_DURATION is plenty
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + CACHE_DURATION
+        for key in [k for k, e in self._entries.items() if now >= e[0] + STALE_WHILE_REVALIDATE]:
+            self._intervals -= len(self._entries.pop(key)[1])
+            self.expirations += 1
 
-# Webhook channel tracking (in-memory, will be persisted to DB)
+    def discard(self, predicate=None):
+        """Drop every day (or the days whose key matches predicate)."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate is None or predicate(k)]:
+                self._intervals -= len(self._entries.pop(key)[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "days": len(self._entries),
+                "intervals": self._intervals,
+                "max_days": self.max_days,
+                "max_intervals": self.max_intervals,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+# ⚡ THE CACHE STORAGE ⚡
+# Busy times are cached per calendar, per local day, so any requested range is assembled
+# from the days we already hold and only the missing days go to Google.
+_DAY_CACHE = DayCache(
+    max_days=int(os.getenv("GCAL_CACHE_MAX_DAYS", "2000")),
+    max_intervals=int(os.getenv("GCAL_CACHE_MAX_INTERVALS", "50000")),
+)
+
+# Incremental sync: a local event store per calendar kept current with syncToken deltas.
+# Days inside the sync window are served from the store; only days beyond it hit events.list.
+INCREMENTAL_SYNC = os.getenv("GCAL_INCREMENTAL_SYNC", "true").lower() in ("1", "true", "yes")
+SYNC_PAST_DAYS = 1
+SYNC_HORIZON_DAYS = int(os.getenv("GCAL_SYNC_HORIZON_DAYS", "60"))
+_EVENT_STORE = {}  # calendar_id -> {event_id: Busy}
+_SYNC_STATE = {}   # calendar_id -> {"token": nextSyncToken, "window": (first_day, last_day)}
+_SYNC_LOCKS = {}   # calendar_id -> RLock (one sync per calendar at a time)
+
+# Webhook channel tracking (mirrored in the webhook_channels table so restarts reuse them)
 _ACTIVE_CHANNELS = {}
+CHANNEL_TTL = timedelta(days=7)  # Maximum lifetime Google allows for a channel
+CHANNEL_RENEW_MARGIN = 60 * 60   # Seconds before expiry at which a channel is replaced
+_STOPPING_CHANNELS = set()       # Stale channel IDs with a stop request under way
+_CHANNEL_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gcal-channels")  # Never competes with refreshes
+# Every channel carries token = HMAC(secret, channel_id); Google echoes it in X-Goog-Channel-Token,
+# so notifications from channels we didn't create are ignored, even after a restart.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or os.getenv("SECRET_KEY", "fallback_secret_for_dev_only")
+
+# Google sends notifications in bursts; each calendar gets one refresh per burst
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "2"))
+_PENDING_CHANGES = {}  # calendar_id (or None = unknown channel) -> threading.Timer handing off to _REFRESH_POOL
+_PENDING_LOCK = threading.Lock()
 
 def clear_cache():
-    """Clear all cached calendar data."""
-    global _CALENDAR_CACHE, _CACHE_TIMESTAMP
-    _CALENDAR_CACHE = {}
-    _CACHE_TIMESTAMP = {}
+    """Clear all cached calendar data (and every availability result built from it)."""
+    _DAY_CACHE.discard()
+    availability.invalidate()
     print("🧹 Cache cleared!")
 
+def invalidate_calendar(cal_id):
+    """Drop one calendar's cached days (the others stay warm) and any availability built from them."""
+    _DAY_CACHE.discard(lambda key: key[0] == cal_id)
+    availability.invalidate()
+    print(f"🧹 Cache cleared for {cal_id[:15]}...")
+
+def get_calendar_ids():
+    return ['primary'] + EXTRA_CALENDAR_IDS
+
+def _days_between(start_date, end_date):
+    """Inclusive list of YYYY-MM-DD strings."""
+    first = datetime.strptime(start_date, "%Y-%m-%d")
+    count = (datetime.strptime(end_date, "%Y-%m-%d") - first).days + 1
+    return [(first + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(max(count, 0))]
+
 def get_cache_timestamp(start_iso, end_iso):
-    """Get the timestamp when cache was last updated for a date range."""
-    cache_key = f"{start_iso}_{end_iso}"
-    return _CACHE_TIMESTAMP.get(cache_key, 0)
+    """Get when the stalest cached day in a date range was fetched (0 if any day is missing)."""
+    timestamps = []
+    for cal_id in get_calendar_ids():
+        for day in _days_between(start_iso[:10], end_iso[:10]):
+            entry = _DAY_CACHE.get((cal_id, day))
+            if not entry:
+                return 0
+            timestamps.append(entry[2])
+    return min(timestamps) if timestamps else 0
 
-def get_service():
+def get_cache_stats():
+    """Day-cache size and hit/miss/eviction counters (for the admin dashboard)."""
+    return _DAY_CACHE.stats()
+
+# --- LONG-LIVED CREDENTIALS & SERVICE ---
+# token.json is read once per process; the access token is refreshed shortly before it
+# expires, and each worker thread builds its Calendar service once (httplib2 isn't thread-safe).
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+_CREDS = None
+_CREDS_LOCK = threading.Lock()
+_THREAD_LOCAL = threading.local()
+
+def _token_path():
+    return 'backend/token.json' if os.path.exists('backend/token.json') else 'token.json'
+
+def _save_credentials(creds):
+    with open(_token_path(), 'w') as token:
+        token.write(creds.to_json())
+
+def _load_credentials():
     creds = None
-    token_path = 'backend/token.json' if os.path.exists('backend/token.json') else 'token.json'
+    token_path = _token_path()
     cred_path = 'backend/credentials.json' if os.path.exists('backend/credentials.json') else 'credentials.json'
 
     if os.path.exists(token_path):
@@ -65,124 +225,570 @@ def get_service():
                 creds = flow.run_local_server(port=0)
             else:
                 return None
-        with open(token_path, 'w') as token:
-            token.write(creds.to_json())
-    return build('calendar', 'v3', credentials=creds)
+        _save_credentials(creds)
+    return creds
 
-def fetch_events_from_calendar(service, calendar_id, t_min, t_max):
-    try:
+def get_credentials():
+    """Process-wide credentials, loaded once and refreshed proactively. Safe from any thread."""
+    global _CREDS
+    with _CREDS_LOCK:
+        if _CREDS is None:
+            _CREDS = _load_credentials()  # Not cached when missing: lifespan may restore token.json later
+        elif _CREDS.refresh_token and (
+            not _CREDS.token or
+            (_CREDS.expiry and _CREDS.expiry - TOKEN_REFRESH_MARGIN <= datetime.utcnow())
+        ):
+            try:
+                _CREDS.refresh(Request())
+                _save_credentials(_CREDS)
+            except Exception as e:
+                print(f"⚠️ Token refresh failed: {e}")
+        return _CREDS
+
+def get_service():
+    """Calendar service for the calling thread, built on first use around the shared credentials."""
+    creds = get_credentials()
+    if not creds:
+        return None
+    if getattr(_THREAD_LOCAL, 'creds', None) is not creds:
+        _THREAD_LOCAL.service = build('calendar', 'v3', credentials=creds)
+        _THREAD_LOCAL.creds = creds
+    return _THREAD_LOCAL.service
+
+# Only the parts of an event normalize_event reads (plus id/nextSyncToken for delta sync);
+# descriptions, attendees and conference data are never transferred or parsed.
+EVENT_FIELDS = 'items(id,start,end,summary,colorId,status,transparency,etag),nextPageToken,nextSyncToken'
+PAGE_SIZE = 2500  # API maximum: a dense sync window fits one page, i.e. one batch round
+
+def list_events(service, calendar_id, t_min, t_max, http=None):
+    """Raw events.list call, following every page; raises on failure so callers can decide what to cache."""
+    items = []
+    page_token = None
+    while True:
         events_result = service.events().list(
             calendarId=calendar_id, 
             timeMin=t_min, 
             timeMax=t_max, 
             singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        return events_result.get('items', [])
+            orderBy='startTime',
+            maxResults=PAGE_SIZE,
+            fields=EVENT_FIELDS,
+            pageToken=page_token
+        ).execute(http=http)
+        items.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return items
+
+def fetch_events_from_calendar(service, calendar_id, t_min, t_max, http=None):
+    try:
+        return list_events(service, calendar_id, t_min, t_max, http=http)
     except Exception as e:
         print(f"⚠️ Failed to fetch from {calendar_id[:15]}...: {e}")
         return []
 
-def get_google_busy_times(start_iso, end_iso, force_refresh=False):
-    """
-    Get busy times from Google Calendar.
+# --- BUFFER CLASSIFICATION ---
+# Built once from the config: every keyword in one case-insensitive pattern, colours in a set.
+# debug_availability.py uses the same functions, so its diagnosis always matches production.
+_BUFFER_PATTERN = re.compile("|".join(re.escape(w) for w in BUFFER_KEYWORDS), re.IGNORECASE)
+_BUFFER_COLORS = frozenset(BUFFER_COLOR_IDS)
+
+def is_buffered_event(summary, color_id):
+    """True if an event gets BUFFER_MINUTES of padding (keyword in the title or a buffer colour)."""
+    return color_id in _BUFFER_COLORS or _BUFFER_PATTERN.search(summary) is not None
+
+def buffer_reasons(summary, color_id):
+    """Human-readable reasons an event is buffered (empty list if it isn't)."""
+    reasons = [f"Keyword match: '{m.group(0).lower()}'" for m in _BUFFER_PATTERN.finditer(summary) if m.group(0)]
+    if color_id in _BUFFER_COLORS:
+        reasons.append(f"Color match: ID {color_id or '(none)'}")
+    if not reasons and is_buffered_event(summary, color_id):
+        reasons.append("Empty keyword in BUFFER_KEYWORDS")  # '' matches every title
+    return reasons
+
+# Normalised intervals by (event id, etag): an unchanged event is never parsed twice
+NORMALIZE_MEMO_MAX = 20000
+_NORMALIZED = {}
+_NORMALIZED_LOCK = threading.Lock()
+
+def normalize_event(event):
+    """Turn a Google event into a busy.Busy interval (None if it can't be parsed)."""
+    key = (event.get('id'), event.get('etag'))
+    if key[0] is None or key[1] is None:
+        return _normalize_event(event)
+    with _NORMALIZED_LOCK:
+        if key in _NORMALIZED:
+            return _NORMALIZED[key]
+    interval = _normalize_event(event)
+    with _NORMALIZED_LOCK:
+        if len(_NORMALIZED) >= NORMALIZE_MEMO_MAX:
+            del _NORMALIZED[next(iter(_NORMALIZED))]  # Oldest first
+        _NORMALIZED[key] = interval
+    return interval
+
+def _normalize_event(event):
+    start_str = event['start'].get('dateTime') or event['start'].get('date')
+    end_str = event['end'].get('dateTime') or event['end'].get('date')
     
+    try:
+        is_all_day = 'T' not in start_str
+        
+        if not is_all_day:
+            dt = datetime.fromisoformat(start_str.replace('Z', '+00:00'))
+            start_dt = dt
+            end_dt = datetime.fromisoformat(end_str.replace('Z', '+00:00'))
+        else:
+            # Handle All Day Events (Midnight to Midnight)
+            dt_naive = datetime.strptime(start_str, "%Y-%m-%d")
+            start_dt = BRISBANE_TZ.localize(dt_naive)
+            # Google All-Day ends on the NEXT day 00:00, which is correct
+            end_dt_naive = datetime.strptime(end_str, "%Y-%m-%d")
+            end_dt = BRISBANE_TZ.localize(end_dt_naive)
+
+    except:
+        return None
+
+    # Check Logic
+    is_buffered = is_buffered_event(event.get('summary', ''), event.get('colorId', ''))
+
+    # NOTE: All calendar events block availability (transparency is ignored).
+
+    # 🟢 FIX 2: Only Buffer NON-All-Day events
+    # Buffering an all-day event makes it overlap into yesterday/tomorrow
+    if is_buffered and not is_all_day:
+        start_dt -= timedelta(minutes=BUFFER_MINUTES)
+        end_dt += timedelta(minutes=BUFFER_MINUTES)
+
+    return busy.from_datetimes(start_dt, end_dt, "GOOGLE_CAL")
+
+def _utc_iso(epoch_minutes):
+    """RFC 3339 UTC timestamp for an epoch minute, as Google expects for timeMin/timeMax."""
+    return datetime.fromtimestamp(epoch_minutes * 60, pytz.utc).isoformat().replace("+00:00", "Z")
+
+def _stale_days(cal_id, days, force_refresh, hits):
+    """
+    Split a calendar's days by how urgently they need fetching.
+
     Args:
-        start_iso: Start date/time in ISO format
-        end_iso: End date/time in ISO format
-        force_refresh: If True, bypass cache and fetch fresh data
-    
+        hits: Filled with {(calendar_id, day): busy} for every day that can be served as-is
+
     Returns:
-        List of normalized busy time slots
+        (blocking, revalidate): days that must be fetched before answering (missing, too old or
+        forced), and expired days that can still be served while refreshing in the background
     """
-    # 1. CHECK CACHE (unless force refresh requested)
-    cache_key = f"{start_iso}_{end_iso}"
-    if not force_refresh and cache_key in _CALENDAR_CACHE:
-        expiry, data = _CALENDAR_CACHE[cache_key]
-        if time.time() < expiry:
-            print("⚡ USING CACHED DATA")
-            return data
+    now = time.time()
+    blocking = []
+    revalidate = []
+    for day in days:
+        entry = None if force_refresh else _DAY_CACHE.lookup((cal_id, day), now)
+        if not entry:
+            blocking.append(day)
+            continue
+        hits[(cal_id, day)] = entry[1]
+        if now >= entry[0]:
+            revalidate.append(day)
+    return blocking, revalidate
 
-    service = get_service()
-    if not service: return []
-
-    # Timezone Helper
-    def to_utc_iso(iso_str):
-        if "T" in iso_str and "Z" not in iso_str:
-            dt_naive = datetime.fromisoformat(iso_str)
-            dt_brisbane = BRISBANE_TZ.localize(dt_naive)
-            dt_utc = dt_brisbane.astimezone(pytz.utc)
-            return dt_utc.isoformat().replace("+00:00", "Z")
-        return iso_str + "Z"
-
-    t_min = to_utc_iso(start_iso)
-    t_max = to_utc_iso(end_iso)
-
-    calendars = ['primary'] + EXTRA_CALENDAR_IDS
-    all_events = []
-    
-    for cal_id in calendars:
-        all_events.extend(fetch_events_from_calendar(service, cal_id, t_min, t_max))
+def _group_runs(days):
+    """Group sorted days into contiguous (first, last) runs."""
+    runs = []
+    for day in days:
+        if runs and (datetime.strptime(day, "%Y-%m-%d") - datetime.strptime(runs[-1][1], "%Y-%m-%d")).days == 1:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return runs
 
-    normalized = []
-    for event in all_events:
-        start_str = event['start'].get('dateTime') or event['start'].get('date')
-        end_str = event['end'].get('dateTime') or event['end'].get('date')
-        
-        try:
-            is_all_day = 'T' not in start_str
-            
-            if not is_all_day:
-                dt = datetime.fromisoformat(start_str.replace('Z', '+00:00'))
-                start_dt = dt
-                end_dt = datetime.fromisoformat(end_str.replace('Z', '+00:00'))
-            else:
-                # Handle All Day Events (Midnight to Midnight)
-                dt_naive = datetime.strptime(start_str, "%Y-%m-%d")
-                start_dt = BRISBANE_TZ.localize(dt_naive)
-                # Google All-Day ends on the NEXT day 00:00, which is correct
-                end_dt_naive = datetime.strptime(end_str, "%Y-%m-%d")
-                end_dt = BRISBANE_TZ.localize(end_dt_naive)
-
-        except:
+def _store_run(cal_id, first_day, last_day, intervals, fetched_at, expires_at=None, collect=None):
+    """
+    Split a fetched run into per-day buckets. Returns True if any day's busy times changed.
+    Buckets are also written to collect ({(calendar_id, day): busy}) when given, since the
+    cache may evict them again before the caller gets to read them.
+    """
+    if expires_at is None:
+        expires_at = fetched_at + CACHE_DURATION
+    changed = False
+    for day in _days_between(first_day, last_day):
+        day_start = busy.day_start_minutes(day)
+        day_end = day_start + 24 * 60
+        # A zero-length event at midnight belongs to the day it starts
+        bucket = sorted(b for b in intervals if b.start < day_end and (b.end > day_start or b.start == day_start))
+        previous = _DAY_CACHE.put((cal_id, day), expires_at, bucket, fetched_at)
+        if collect is not None:
+            collect[(cal_id, day)] = bucket
+        if previous is not None and previous != bucket:
+            changed = True
+    return changed
+
+# --- INCREMENTAL SYNC ---
+
+def _sync_window():
+    """Days the event store covers: from yesterday to SYNC_HORIZON_DAYS ahead (local time)."""
+    today = datetime.now(BRISBANE_TZ).replace(tzinfo=None)
+    return (
+        (today - timedelta(days=SYNC_PAST_DAYS)).strftime("%Y-%m-%d"),
+        (today + timedelta(days=SYNC_HORIZON_DAYS)).strftime("%Y-%m-%d"),
+    )
+
+def _in_sync_window(cal_id, day):
+    if not INCREMENTAL_SYNC:
+        return False
+    first, last = _SYNC_STATE.get(cal_id, {}).get('window') or _sync_window()
+    return first <= day <= last
+
+def _sync_job(cal_id, window):
+    """Delta job when we hold a token for the current window, otherwise a full load of it."""
+    state = _SYNC_STATE.get(cal_id)
+    if state and state['window'] == window:
+        return ListJob(cal_id, syncToken=state['token'])
+    first, last = window
+    return ListJob(
+        cal_id,
+        timeMin=_utc_iso(busy.day_start_minutes(first) - BUFFER_MINUTES),
+        timeMax=_utc_iso(busy.day_start_minutes(last) + 24 * 60 + BUFFER_MINUTES),
+    )
+
+def _apply_sync(cal_id, job, window, fetched_at, collect=None):
+    """Fold a finished sync job into the event store and rebuild the window's day buckets."""
+    previous = _EVENT_STORE.get(cal_id, {})
+    store = dict(previous) if job.incremental else {}
+    for event in job.items:
+        interval = None if event.get('status') == 'cancelled' else normalize_event(event)
+        if interval:
+            store[event['id']] = interval
+        else:
+            store.pop(event.get('id'), None)
+    _EVENT_STORE[cal_id] = store
+
+    if job.sync_token:
+        _SYNC_STATE[cal_id] = {"token": job.sync_token, "window": window}
+    else:
+        # Google didn't hand out a token; keep serving from the store, re-load next time
+        _SYNC_STATE.pop(cal_id, None)
+    _persist_snapshot(cal_id, store, job.sync_token, window, fetched_at, store != previous)
+
+    if job.items and job.incremental:
+        print(f"🔁 Delta sync for {cal_id[:15]}...: {len(job.items)} changed events")
+    return _store_run(cal_id, window[0], window[1], list(store.values()), fetched_at, collect=collect)
+
+
+# --- WARM RESTARTS ---
+# The event store and sync tokens are mirrored into carbon.db, so a redeploy can answer
+# availability straight away from the last known state while a delta sync catches up.
+
+def _persist_snapshot(cal_id, store, sync_token, window, fetched_at, events_changed):
+    try:
+        database.save_calendar_snapshot(cal_id, store, sync_token, window, fetched_at, events_changed)
+    except Exception as e:
+        print(f"⚠️ Failed to persist calendar snapshot for {cal_id[:15]}...: {e}")
+
+def load_snapshot():
+    """
+    Seed the event store and day cache from the persisted snapshot. Days are served as if
+    fresh for one CACHE_DURATION, which is the window revalidate_snapshot has to catch up.
+
+    Returns:
+        Calendar IDs that were loaded (and need revalidating)
+    """
+    if not INCREMENTAL_SYNC:
+        return []
+    window = _sync_window()
+    loaded_at = time.time()
+    loaded = []
+    for cal_id, snapshot in database.load_calendar_snapshots().items():
+        if cal_id not in get_calendar_ids():
             continue
+        _EVENT_STORE[cal_id] = snapshot["events"]
+        if snapshot["token"] and snapshot["window"] == window:
+            _SYNC_STATE[cal_id] = {"token": snapshot["token"], "window": window}
+        # Only the days both windows cover; anything newer is fetched normally
+        first, last = max(snapshot["window"][0], window[0]), min(snapshot["window"][1], window[1])
+        if first <= last:
+            _store_run(cal_id, first, last, list(snapshot["events"].values()),
+                       snapshot["synced_at"], expires_at=loaded_at + CACHE_DURATION)
+        loaded.append(cal_id)
+    if loaded:
+        print(f"💾 Loaded calendar snapshot for {len(loaded)} calendar(s)")
+    return loaded
+
+def revalidate_snapshot(calendar_ids):
+    """Bring snapshot-loaded calendars up to date (delta sync when the stored token is still usable)."""
+    if not calendar_ids:
+        return
+    _, failed = refresh_work(calendar_ids, [])
+    print(f"🔄 Revalidated {len(calendar_ids) - len(failed)}/{len(calendar_ids)} snapshot calendar(s)")
+
+
+# --- BATCHED FETCHING ---
+
+BATCH_LIMIT = 50  # Calendar API accepts at most 50 calls per batch request
+
+class ListJob:
+    """One paginated events.list call, advanced a page per batch round."""
+
+    def __init__(self, cal_id, **params):
+        self.cal_id = cal_id
+        self.params = params
+        self.incremental = 'syncToken' in params
+        self.items = []
+        self.page_token = None
+        self.sync_token = None
+        self.error = None
+        self.done = False
+
+    def request(self, service):
+        return service.events().list(
+            calendarId=self.cal_id,
+            singleEvents=True,
+            maxResults=PAGE_SIZE,
+            fields=EVENT_FIELDS,
+            pageToken=self.page_token,
+            **self.params
+        )
+
+    def on_page(self, request_id, response, exception):
+        if exception is not None:
+            self.fail(exception)
+            return
+        self.items.extend(response.get('items', []))
+        self.page_token = response.get('nextPageToken')
+        if not self.page_token:
+            self.sync_token = response.get('nextSyncToken')
+            self.done = True
+
+    def fail(self, exception):
+        self.error = exception
+        self.done = True
 
-        # Check Logic
-        title = event.get('summary', '').lower()
-        color = event.get('colorId', '') 
+    def token_expired(self):
+        """410 Gone on a delta request: the sync token is no longer valid."""
+        return self.incremental and isinstance(self.error, HttpError) and self.error.resp.status == 410
+
+def run_batched(service, jobs):
+    """
+    Run events.list jobs through Google's batch endpoint. Each round sends the next page of
+    every unfinished job in one HTTP request, so cold latency no longer grows with the
+    number of calendars. Errors are recorded per job and never affect the others.
+    """
+    pending = list(jobs)
+    while pending:
+        for i in range(0, len(pending), BATCH_LIMIT):
+            chunk = pending[i:i + BATCH_LIMIT]
+            batch = service.new_batch_http_request()
+            for job in chunk:
+                batch.add(job.request(service), callback=job.on_page)
+            try:
+                batch.execute()  # Over the thread's own service connection, kept alive between calls
+            except Exception as e:
+                for job in chunk:
+                    if not job.done:
+                        job.fail(e)
+        pending = [job for job in pending if not job.done]
+
+def refresh_calendars(service, sync_cals, runs, collect=None):
+    """
+    Delta-sync whole calendars and fetch runs of days, sharing the same batch rounds,
+    then write everything into the day cache.
+
+    Args:
+        sync_cals: Calendar IDs to bring up to date through the event store
+        runs: (calendar_id, first_day, last_day) ranges fetched directly (outside the sync window)
+        collect: Optional dict receiving every day bucket written, keyed (calendar_id, day)
+
+    Returns:
+        (changed, failed): whether any cached busy times changed, and the calendar IDs that failed
+    """
+    locks = [_SYNC_LOCKS.setdefault(cal_id, threading.RLock()) for cal_id in sorted(set(sync_cals))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        window = _sync_window()
+        sync_jobs = {cal_id: _sync_job(cal_id, window) for cal_id in sync_cals}
+        run_jobs = []
+        for cal_id, first, last in runs:
+            # Pad by the buffer so buffered events just outside the run still land in it
+            run_jobs.append(((cal_id, first, last), ListJob(
+                cal_id,
+                timeMin=_utc_iso(busy.day_start_minutes(first) - BUFFER_MINUTES),
+                timeMax=_utc_iso(busy.day_start_minutes(last) + 24 * 60 + BUFFER_MINUTES),
+            )))
+        run_batched(service, list(sync_jobs.values()) + [job for _, job in run_jobs])
 
-        is_buffered = False
-        if any(w in title for w in BUFFER_KEYWORDS): is_buffered = True
-        if color in BUFFER_COLOR_IDS: is_buffered = True
+        # Expired sync tokens (410 Gone) fall back to a full load of the window
+        expired = [cal_id for cal_id, job in sync_jobs.items() if job.token_expired()]
+        if expired:
+            for cal_id in expired:
+                print(f"♻️ Sync token expired for {cal_id[:15]}..., doing a full resync")
+                _SYNC_STATE.pop(cal_id, None)
+                sync_jobs[cal_id] = _sync_job(cal_id, window)
+            run_batched(service, [sync_jobs[cal_id] for cal_id in expired])
 
-        # NOTE: All calendar events block availability (transparency is ignored).
+        fetched_at = time.time()
+        changed = False
+        failed = set()
+        for (cal_id, first, last), job in run_jobs:
+            if job.error:
+                print(f"⚠️ Failed to fetch from {cal_id[:15]}...: {job.error}")
+                failed.add(cal_id)
+                continue
+            intervals = [b for b in (normalize_event(e) for e in job.items) if b]
+            changed |= _store_run(cal_id, first, last, intervals, fetched_at, collect=collect)
+        for cal_id, job in sync_jobs.items():
+            if job.error:
+                print(f"⚠️ Failed to sync {cal_id[:15]}...: {job.error}")
+                failed.add(cal_id)
+                continue
+            changed |= _apply_sync(cal_id, job, window, fetched_at, collect=collect)
+        return changed, failed
+    finally:
+        for lock in reversed(locks):
+            lock.release()
 
-        # 🟢 FIX 2: Only Buffer NON-All-Day events
-        # Buffering an all-day event makes it overlap into yesterday/tomorrow
-        if is_buffered and not is_all_day:
-            start_dt -= timedelta(hours=1)
-            end_dt += timedelta(hours=1)
+# --- SINGLE-FLIGHT REFRESHING ---
+# Work is keyed per unit: ('sync', calendar_id) or ('run', calendar_id, first_day, last_day).
+# A unit already being fetched is never fetched twice; later callers wait for the first one.
+FLIGHT_TIMEOUT = 30  # Seconds a caller waits on someone else's fetch before answering anyway
+_IN_FLIGHT = {}  # unit -> (threading.Event set when that fetch finishes, {(calendar_id, day): busy} it fetched)
+_IN_FLIGHT_LOCK = threading.Lock()
+_REFRESH_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gcal-refresh")
 
-        duration = int((end_dt - start_dt).total_seconds() / 60)
-        local_start = start_dt.astimezone(BRISBANE_TZ)
+def _work_units(sync_cals, runs):
+    return [('sync', cal_id) for cal_id in sync_cals] + [('run',) + tuple(run) for run in runs]
 
-        normalized.append({
-            "date": local_start.strftime("%Y-%m-%d"),
-            "time": local_start.strftime("%H:%M"),
-            "duration": duration,
-            "source": "GOOGLE_CAL"
-        })
+def refresh_work(sync_cals, runs, collect=None):
+    """
+    Single-flight wrapper around refresh_calendars: units nobody is fetching are fetched here
+    in one batch, units already in flight are waited on instead of fetched again.
+
+    Args:
+        collect: Optional dict receiving the day buckets of every unit, fetched here or waited on
+
+    Returns:
+        (changed, failed) for the units this call fetched itself
+    """
+    claimed = []
+    waiting = []
+    fetched = {}
+    with _IN_FLIGHT_LOCK:
+        for unit in _work_units(sync_cals, runs):
+            if unit in _IN_FLIGHT:
+                waiting.append(_IN_FLIGHT[unit])
+            else:
+                _IN_FLIGHT[unit] = (threading.Event(), fetched)
+                claimed.append(unit)
+
+    changed, failed = False, set()
+    try:
+        if claimed:
+            claimed_sync = [unit[1] for unit in claimed if unit[0] == 'sync']
+            claimed_runs = [unit[1:] for unit in claimed if unit[0] == 'run']
+            service = get_service()
+            if service:
+                changed, failed = refresh_calendars(service, claimed_sync, claimed_runs, fetched)
+                # Calendar changed without a webhook telling us: bump the availability version
+                if changed:
+                    availability.invalidate()
+            else:
+                failed = {unit[1] for unit in claimed}
+    finally:
+        with _IN_FLIGHT_LOCK:
+            for unit in claimed:
+                _IN_FLIGHT.pop(unit)[0].set()
+
+    if collect is not None:
+        collect.update(fetched)
+    for done, their_fetched in waiting:
+        # Their dict is complete once the event is set; it's never written after that
+        if done.wait(FLIGHT_TIMEOUT) and collect is not None:
+            collect.update(their_fetched)
+    return changed, failed
+
+def _revalidate(sync_cals, runs):
+    try:
+        refresh_work(sync_cals, runs)
+    except Exception as e:
+        print(f"⚠️ Background calendar refresh failed: {e}")
+
+def refresh_in_background(sync_cals, runs):
+    """Queue a refresh for units nobody is already fetching; returns immediately."""
+    with _IN_FLIGHT_LOCK:
+        sync_cals = [cal_id for cal_id in sync_cals if ('sync', cal_id) not in _IN_FLIGHT]
+        runs = [run for run in runs if ('run',) + tuple(run) not in _IN_FLIGHT]
+    if sync_cals or runs:
+        _REFRESH_POOL.submit(_revalidate, sync_cals, runs)
+
+def get_google_busy_times(start_iso, end_iso, force_refresh=False):
+    """
+    Get busy times from Google Calendar.
     
-    current_time = time.time()
-    _CALENDAR_CACHE[cache_key] = (current_time + CACHE_DURATION, normalized)
-    _CACHE_TIMESTAMP[cache_key] = current_time
-    return normalized
+    Args:
+        start_iso: Start date/time in ISO format (only the date part is used)
+        end_iso: End date/time in ISO format (only the date part is used)
+        force_refresh: If True, bypass cache and fetch fresh data
+    
+    Returns:
+        List of busy.Busy intervals
+    """
+    days = _days_between(start_iso[:10], end_iso[:10])
+    calendars = get_calendar_ids()
+
+    # 1. CHECK CACHE (unless force refresh requested): only missing days get fetched.
+    # Stale days inside the sync window cost one delta sync; the rest are fetched by run.
+    # Days that expired only recently are served as-is and refreshed in the background.
+    sync_cals, runs = [], []
+    background_sync, background_runs = [], []
+    hits = {}
+    for cal_id in calendars:
+        blocking, revalidate = _stale_days(cal_id, days, force_refresh, hits)
+        if any(_in_sync_window(cal_id, day) for day in blocking):
+            sync_cals.append(cal_id)
+        elif any(_in_sync_window(cal_id, day) for day in revalidate):
+            background_sync.append(cal_id)
+        runs.extend((cal_id, first, last) for first, last in
+                    _group_runs([day for day in blocking if not _in_sync_window(cal_id, day)]))
+        background_runs.extend((cal_id, first, last) for first, last in
+                               _group_runs([day for day in revalidate if not _in_sync_window(cal_id, day)]))
+
+    # 2. Every sync / fetch goes out in shared batch rounds; failures stay isolated per calendar
+    fetched = {}
+    if sync_cals or runs:
+        refresh_work(sync_cals, runs, collect=fetched)
+    elif not (background_sync or background_runs):
+        print("⚡ USING CACHED DATA")
+    if background_sync or background_runs:
+        print("⚡ SERVING STALE DATA, refreshing in the background")
+        refresh_in_background(background_sync, background_runs)
+
+    # 3. Assemble the range from the buckets just looked up or fetched, never from a second
+    # cache read: the puts above may already have evicted some of them. Events spanning
+    # midnight sit in both days, hence the de-duplication.
+    collected = {}
+    for cal_id in calendars:
+        for day in days:
+            bucket = fetched.get((cal_id, day), hits.get((cal_id, day)))
+            if bucket:
+                collected.update(dict.fromkeys(bucket))
+    return list(collected)
 
 
 # ==========================================
 # GOOGLE CALENDAR WEBHOOK FUNCTIONS
 # ==========================================
 
+def channel_token(channel_id):
+    """Verification token Google sends back with every notification on this channel."""
+    return hmac.new(WEBHOOK_SECRET.encode(), channel_id.encode(), hashlib.sha256).hexdigest()
+
+def is_authentic_notification(channel_id, token):
+    """
+    A notification is ours if its token verifies. Token-less ones are only accepted from
+    channels we're tracking (their random IDs are known only to us and Google), which covers
+    channels created before tokens were added.
+    """
+    if token:
+        return hmac.compare_digest(token.encode(), channel_token(channel_id).encode())  # Bytes: str compare rejects non-ASCII
+    return channel_id in _ACTIVE_CHANNELS
+
 def setup_calendar_watch(calendar_id='primary'):
     """
     Set up a webhook channel to watch for changes on a Google Calendar.
@@ -200,15 +806,18 @@ def setup_calendar_watch(calendar_id='primary'):
         return None
     
     channel_id = str(uuid.uuid4())
+    # Known before Google's 'sync' handshake can arrive, so it's never mistaken for a stale channel
+    _ACTIVE_CHANNELS[channel_id] = {'channel_id': channel_id, 'calendar_id': calendar_id, 'expiration': 0}
     
     try:
         # Channel expires in 7 days (maximum allowed by Google)
-        expiration = int((datetime.utcnow() + timedelta(days=7)).timestamp() * 1000)
+        expiration = int((datetime.utcnow() + CHANNEL_TTL).timestamp() * 1000)
         
         body = {
             'id': channel_id,
             'type': 'web_hook',
             'address': WEBHOOK_URL,
+            'token': channel_token(channel_id),
             'expiration': expiration
         }
         
@@ -221,19 +830,26 @@ def setup_calendar_watch(calendar_id='primary'):
             'channel_id': response.get('id'),
             'resource_id': response.get('resourceId'),
             'calendar_id': calendar_id,
-            'expiration': response.get('expiration'),
+            'expiration': int(response.get('expiration') or expiration),
             'created_at': datetime.utcnow().isoformat()
         }
         
         _ACTIVE_CHANNELS[channel_id] = channel_info
+        database.save_webhook_channel(channel_info)
         print(f"✅ Webhook channel set up for {calendar_id}: {channel_id}")
         return channel_info
         
     except Exception as e:
+        _ACTIVE_CHANNELS.pop(channel_id, None)
         print(f"❌ Failed to set up webhook for {calendar_id}: {e}")
         return None
 
 
+def _forget_channel(channel_id):
+    _ACTIVE_CHANNELS.pop(channel_id, None)
+    database.delete_webhook_channel(channel_id)
+
+
 def stop_calendar_watch(channel_id, resource_id):
     """Stop watching a calendar channel."""
     service = get_service()
@@ -246,53 +862,134 @@ def stop_calendar_watch(channel_id, resource_id):
             'resourceId': resource_id
         }).execute()
         
-        if channel_id in _ACTIVE_CHANNELS:
-            del _ACTIVE_CHANNELS[channel_id]
-            
+        _forget_channel(channel_id)
         print(f"✅ Stopped watching channel: {channel_id}")
         return True
         
+    except HttpError as e:
+        if e.resp.status == 404:
+            _forget_channel(channel_id)  # Already expired or stopped on Google's side
+            return True
+        print(f"⚠️ Failed to stop channel {channel_id}: {e}")
+        return False
     except Exception as e:
         print(f"⚠️ Failed to stop channel {channel_id}: {e}")
         return False
 
 
 def setup_all_calendar_watches():
-    """Set up webhook watches for all configured calendars."""
-    calendars = ['primary'] + EXTRA_CALENDAR_IDS
+    """
+    Make sure every configured calendar has a live webhook channel, reusing the channels
+    stored by previous runs. Expiring, duplicate and no-longer-configured channels are
+    replaced or stopped, so restarts don't leak channels.
+    """
+    calendars = get_calendar_ids()
+    now_ms = time.time() * 1000
     results = []
     
+    for channel in database.get_webhook_channels():  # Latest expiration first
+        cal_id = channel['calendar_id']
+        reusable = (
+            cal_id in calendars and
+            channel['expiration'] - now_ms > CHANNEL_RENEW_MARGIN * 1000 and
+            not any(c['calendar_id'] == cal_id for c in results)
+        )
+        if reusable:
+            _ACTIVE_CHANNELS[channel['channel_id']] = channel
+            results.append(channel)
+        elif channel['expiration'] > now_ms:
+            stop_calendar_watch(channel['channel_id'], channel['resource_id'])
+        else:
+            _forget_channel(channel['channel_id'])  # Google has already dropped it
+    reused = len(results)
+    
     for cal_id in calendars:
-        result = setup_calendar_watch(cal_id)
-        if result:
-            results.append(result)
+        if not any(c['calendar_id'] == cal_id for c in results):
+            result = setup_calendar_watch(cal_id)
+            if result:
+                results.append(result)
     
-    print(f"📡 Set up {len(results)}/{len(calendars)} calendar watches")
+    print(f"📡 Set up {len(results)}/{len(calendars)} calendar watches ({reused} reused)")
     return results
 
 
-def handle_webhook_notification(channel_id, resource_id, resource_state):
+def _calendar_for_channel(channel_id, resource_id):
+    """Map a notification back to its calendar: by channel, else by the calendar's resource ID."""
+    info = _ACTIVE_CHANNELS.get(channel_id)
+    if info:
+        return info.get('calendar_id')
+    for info in list(_ACTIVE_CHANNELS.values()):
+        if info.get('resource_id') == resource_id:
+            return info.get('calendar_id')
+    return None
+
+def _apply_calendar_change(cal_id):
+    """Debounced follow-up to a change notification; runs on _REFRESH_POOL, off the request path."""
+    with _PENDING_LOCK:
+        _PENDING_CHANGES.pop(cal_id, None)  # Notifications from now on schedule a fresh refresh
+
+    try:
+        if cal_id is None:
+            # Can't tell which calendar changed: fall back to the old behaviour
+            clear_cache()
+            return
+
+        # A calendar we hold a sync token for only needs a delta fetch.
+        # Deliberately not single-flight: a sync already in flight may predate this change.
+        # The per-calendar sync lock queues this delta behind it instead.
+        if cal_id in _SYNC_STATE:
+            service = get_service()
+            changed, failed = refresh_calendars(service, [cal_id], []) if service else (False, {cal_id})
+            if changed:
+                availability.invalidate()
+            if not failed:
+                print(f"🔄 Delta-synced {cal_id[:15]}... after change notification")
+                return
+
+        invalidate_calendar(cal_id)
+    except Exception as e:
+        print(f"⚠️ Webhook refresh failed for {cal_id}: {e}")
+
+def handle_webhook_notification(channel_id, resource_id, resource_state, token=None):
     """
     Handle incoming webhook notification from Google Calendar.
-    Called when Google notifies us of a calendar change.
+    Called when Google notifies us of a calendar change. Only schedules work, so the
+    webhook can be acked straight away.
     
     Args:
         channel_id: The ID of the notification channel
         resource_id: The resource ID being watched
         resource_state: The state of the resource (sync, exists, etc.)
+        token: The X-Goog-Channel-Token header
     
     Returns:
-        bool indicating if cache was cleared
+        bool indicating if a refresh was scheduled (or already pending) for this change
     """
-    print(f"📬 Webhook received: channel={channel_id}, state={resource_state}")
-    
-    # Clear cache immediately on any change notification
-    if resource_state in ('exists', 'sync'):
-        clear_cache()
-        print("🔄 Cache invalidated due to calendar change")
-        return True
-    
-    return False
+    # The endpoint is public: forged notifications must not stop channels or flush caches
+    if not is_authentic_notification(channel_id, token):
+        print(f"🚫 Ignoring unverified webhook for channel {channel_id}")
+        return False
+
+    # A channel we no longer track (leaked by an old deploy) keeps notifying until stopped
+    if channel_id not in _ACTIVE_CHANNELS and channel_id not in _STOPPING_CHANNELS:
+        _STOPPING_CHANNELS.add(channel_id)
+        _CHANNEL_POOL.submit(_stop_stale_channel, channel_id, resource_id)
+
+    # 'sync' is the handshake Google sends when a channel opens; nothing has changed
+    if resource_state != 'exists':
+        return False
+
+    cal_id = _calendar_for_channel(channel_id, resource_id)
+    with _PENDING_LOCK:
+        if cal_id in _PENDING_CHANGES:
+            return True  # Folded into the refresh already scheduled for this burst
+        # The timer only hands off: the refresh runs on a pool thread that keeps its Calendar service
+        timer = threading.Timer(WEBHOOK_DEBOUNCE_SECONDS, _REFRESH_POOL.submit, args=(_apply_calendar_change, cal_id))
+        timer.daemon = True
+        _PENDING_CHANGES[cal_id] = timer
+    timer.start()
+    print(f"⏳ Refresh scheduled for {(cal_id or 'all calendars')[:15]} in {WEBHOOK_DEBOUNCE_SECONDS:g}s")
+    return True
 
 
 def get_active_channels():
@@ -301,25 +998,43 @@ def get_active_channels():
 
 
 def renew_expiring_channels():
-    """Check and renew any channels expiring within 24 hours."""
-    now = datetime.utcnow().timestamp() * 1000
-    renewal_threshold = now + (24 * 60 * 60 * 1000)  # 24 hours from now
+    """Replace channels within CHANNEL_RENEW_MARGIN of expiring (new channel first, so no change is missed)."""
+    renewal_threshold = (time.time() + CHANNEL_RENEW_MARGIN) * 1000
     
     renewed = []
     for channel_id, info in list(_ACTIVE_CHANNELS.items()):
         if info.get('expiration', 0) < renewal_threshold:
-            # Stop old channel
-            stop_calendar_watch(channel_id, info.get('resource_id'))
-            # Create new channel
             new_channel = setup_calendar_watch(info.get('calendar_id'))
             if new_channel:
                 renewed.append(new_channel)
+                stop_calendar_watch(channel_id, info.get('resource_id'))
     
     if renewed:
         print(f"🔄 Renewed {len(renewed)} expiring channels")
     
     return renewed
 
+
+def seconds_until_next_renewal(max_wait=24 * 60 * 60, min_wait=60):
+    """How long the renewal scheduler can sleep: until just before the earliest channel expires."""
+    expirations = [info.get('expiration', 0) for info in list(_ACTIVE_CHANNELS.values())]
+    if not expirations:
+        return max_wait
+    wait = min(expirations) / 1000 - CHANNEL_RENEW_MARGIN - time.time()
+    return min(max(wait, min_wait), max_wait)
+
+
+def _stop_stale_channel(channel_id, resource_id):
+    try:
+        if channel_id in _ACTIVE_CHANNELS or database.get_webhook_channel(channel_id):
+            return  # Another worker (or a channel being renewed) owns it
+        print(f"🛑 Stopping stale webhook channel {channel_id}")
+        stop_calendar_watch(channel_id, resource_id)
+    except Exception as e:
+        print(f"⚠️ Failed to stop stale channel {channel_id}: {e}")
+    finally:
+        _STOPPING_CHANNELS.discard(channel_id)
+
 def create_google_event(booking_data):
     # (Keep this function exactly as it was in your previous version)
     service = get_service()
@@ -6,6 +6,7 @@ from pydantic import BaseModel
 from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 import database
+import availability
 import pytz
 import auth
 import gcal
@@ -42,7 +43,15 @@ async def lifespan(app: FastAPI):
             print("✅ Restored token.json from Environment")
 
     # 2. Initialize Database
-    database.init_db()
+    await database.run_async(database.init_db)
+
+    # 2b. Serve Google busy times from the last persisted snapshot, then revalidate in the background
+    try:
+        snapshot_calendars = await asyncio.to_thread(gcal.load_snapshot)
+    except Exception as e:
+        snapshot_calendars = []
+        print(f"⚠️ Calendar snapshot load failed (non-fatal): {e}")
+    asyncio.create_task(warm_google_calendar(snapshot_calendars))
     
     # 3. Launch Discord Bot in Background
     asyncio.create_task(bot_service.start_bot())
@@ -51,9 +60,9 @@ async def lifespan(app: FastAPI):
     # 4. Set up Google Calendar Webhooks (if configured)
     if os.getenv("WEBHOOK_URL"):
         try:
-            gcal.setup_all_calendar_watches()
+            await asyncio.to_thread(gcal.setup_all_calendar_watches)
             print("📡 Calendar Webhooks Initialized")
-            # Start background task to renew expiring channels
+            # Start background task to renew channels just before they expire
             asyncio.create_task(webhook_renewal_task())
         except Exception as e:
             print(f"⚠️ Webhook setup failed (non-fatal): {e}")
@@ -64,14 +73,24 @@ async def lifespan(app: FastAPI):
     print("🛑 System Shutting Down...")
 
 
+async def warm_google_calendar(snapshot_calendars):
+    """Warm the Google credentials + Calendar service, then revalidate any snapshot-loaded calendars."""
+    try:
+        await asyncio.to_thread(gcal.get_service)
+        await asyncio.to_thread(gcal.revalidate_snapshot, snapshot_calendars)
+    except Exception as e:
+        print(f"⚠️ Google Calendar warm-up failed (non-fatal): {e}")
+
 async def webhook_renewal_task():
     """Background task to renew webhook channels before they expire."""
     while True:
         try:
-            await asyncio.sleep(6 * 60 * 60)  # Check every 6 hours
-            gcal.renew_expiring_channels()
+            # Sleep until just before the earliest channel expires
+            await asyncio.sleep(gcal.seconds_until_next_renewal())
+            await asyncio.to_thread(gcal.renew_expiring_channels)
         except Exception as e:
             print(f"⚠️ Webhook renewal error: {e}")
+            await asyncio.sleep(60)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -121,28 +140,31 @@ class CancelRequest(BaseModel):
 
 # --- HELPER FUNCTIONS ---
 
-def get_slots_for_day(date_obj, start_hour, end_hour, interval_minutes):
-    slots = []
-    current = date_obj.replace(hour=start_hour, minute=0, second=0, microsecond=0)
-    end_time = date_obj.replace(hour=end_hour, minute=0, second=0, microsecond=0)
-    while current < end_time:
-        slots.append(current.isoformat())
-        current += timedelta(minutes=interval_minutes)
-    return slots
-
-def is_overlapping(slot_iso, duration, occupied_slots):
-    slot_start = datetime.fromisoformat(slot_iso)
-    slot_end = slot_start + timedelta(minutes=duration)
-    for b in occupied_slots:
-        # Handle Google Cal vs Local DB format differences
-        try:
-            b_naive = datetime.strptime(f"{b['date']} {b['time']}", "%Y-%m-%d %H:%M")
-            b_start = AEST.localize(b_naive)
-            b_end = b_start + timedelta(minutes=b['duration'])
-            if slot_start < b_end and slot_end > b_start: return True
-        except:
-            continue
-    return False
+def fetch_occupied(start_date, end_date, force_refresh=False):
+    """Every source of "busy" (bookings, blocks, Google) for an inclusive date range."""
+    local_busy = database.get_local_busy_for_range(start_date, end_date)
+    
+    # Pass force_refresh to calendar fetch
+    google_busy = gcal.get_google_busy_times(
+        start_date + "T00:00:00", 
+        end_date + "T23:59:59",
+        force_refresh=force_refresh
+    )
+    return local_busy + google_busy
+
+async def fetch_occupied_async(start_date, end_date, force_refresh=False):
+    """fetch_occupied with the local and Google sources queried concurrently, off the event loop."""
+    # Both SQLite reads share one trip to the DB thread: one queue slot behind any pending write
+    local_busy, google_busy = await asyncio.gather(
+        database.run_async(database.get_local_busy_for_range, start_date, end_date),
+        asyncio.to_thread(
+            gcal.get_google_busy_times,
+            start_date + "T00:00:00",
+            end_date + "T23:59:59",
+            force_refresh
+        )
+    )
+    return local_busy + google_busy
 
 # --- API ENDPOINTS ---
 
@@ -156,7 +178,7 @@ async def create_meeting(request: MeetingRequest, req: Request):
     is_trusted_ip = client_ip in TRUSTED_IPS
     is_trusted = bool(is_friend or is_trusted_email or is_trusted_ip)
 
-    if not is_trusted and database.is_ip_banned(client_ip):
+    if not is_trusted and await database.run_async(database.is_ip_banned, client_ip):
          raise HTTPException(status_code=403, detail="Your access has been restricted.")
 
     # --- SECURITY LEVEL 1: HONEYPOT (BOT TRAP) ---
@@ -164,7 +186,7 @@ async def create_meeting(request: MeetingRequest, req: Request):
         print(f"🤖 BOT DETECTED: {request.email} from {client_ip}")
         if not is_trusted:
             # Shorter ban to reduce false positives
-            database.ban_ip(client_ip, "Honeypot Triggered", duration_minutes=60)
+            await database.run_async(database.ban_ip, client_ip, "Honeypot Triggered", duration_minutes=60)
             try:
                 await bot_service.bot_instance.send_ban_alert(
                     ip_address=client_ip,
@@ -175,17 +197,17 @@ async def create_meeting(request: MeetingRequest, req: Request):
                 )
             except Exception as e:
                 print(f"⚠️ Failed to send ban alert: {e}")
-        deleted = database.wipe_troll_requests(request.email)
+        deleted = await database.run_async(database.wipe_troll_requests, request.email)
         print(f"💥 Nuclear Option: Deleted {deleted} requests from {request.email}")
         return {"success": True} 
 
     # --- SECURITY LEVEL 2: TROLL SHIELD ---
     if not is_trusted:
-        stats = database.check_spam_stats(request.email)
+        stats = await database.run_async(database.check_spam_stats, request.email)
         if stats['pending'] >= 3:
             raise HTTPException(status_code=429, detail="Too many pending requests.")
         if stats['rejected'] >= 3:
-            database.ban_ip(client_ip, "Troll Shield (3 Rejections)", duration_minutes=1440)
+            await database.run_async(database.ban_ip, client_ip, "Troll Shield (3 Rejections)", duration_minutes=1440)
             try:
                 await bot_service.bot_instance.send_ban_alert(
                     ip_address=client_ip,
@@ -198,6 +220,10 @@ async def create_meeting(request: MeetingRequest, req: Request):
                 print(f"⚠️ Failed to send ban alert: {e}")
             raise HTTPException(status_code=429, detail="Rate limit exceeded. Try again in 24 hours.")
 
+    # Same rule as /api/availability, so only slots it could have offered are bookable
+    if not availability.is_valid_duration(request.duration):
+        raise HTTPException(status_code=400, detail="Invalid duration")
+
     dt = datetime.fromisoformat(request.slot_iso)
     dt_aest = dt.astimezone(AEST)
     
@@ -208,8 +234,9 @@ async def create_meeting(request: MeetingRequest, req: Request):
     if request.token and auth.verify_friend_token(request.token):
         final_topic = f"⚡ [FRIEND] {request.topic}"
 
-    # 1. Save to DB
-    database.add_booking(
+    # 1. Save to DB (re-checks the slot and inserts in one transaction)
+    new_id = await database.run_async(
+        database.add_booking,
         request.name, 
         request.email, 
         final_topic, 
@@ -220,12 +247,9 @@ async def create_meeting(request: MeetingRequest, req: Request):
         request.location_details
     )
     
-    # 2. Get ID
-    conn = database.sqlite3.connect(database.DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='bookings'")
-    new_id = cursor.fetchone()[0]
-    conn.close()
+    # 2. Someone else took (or blocked) the slot since availability was loaded
+    if new_id is None:
+        raise HTTPException(status_code=409, detail="That time slot is no longer available.")
 
     # 3. Send Interactive Alert via Discord Bot (SAFE MODE)
     booking_data = {
@@ -246,12 +270,15 @@ async def create_meeting(request: MeetingRequest, req: Request):
     return {"success": True}
 
 @app.get("/api/availability")
-def get_availability(
+async def get_availability(
     start_date: str, 
     end_date: str, 
-    duration: int, 
+    duration: str, 
+    response: Response,
     token: str = None,
-    force_refresh: bool = False
+    force_refresh: bool = False,
+    slot_format: str = Query("iso", alias="format"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match")
 ):
     """
     Get available time slots for booking.
@@ -259,69 +286,135 @@ def get_availability(
     Args:
         start_date: Start date (YYYY-MM-DD)
         end_date: End date (YYYY-MM-DD)
-        duration: Meeting duration in minutes
+        duration: Meeting duration in minutes, or several comma-separated (e.g. "15,30,60")
         token: Optional friend token for VIP access
         force_refresh: If true, bypass cache and fetch fresh data
+        format: "iso" (default) lists every slot as an ISO-8601 string. "compact" gives
+            [start_minute, slot_count] runs per day, "bitmap" a base64 96-bit mask per day;
+            both are local time with the offset in "utc_offset"
+        if_none_match: ETag from a previous response; answered with 304 if nothing changed
     
     Returns:
-        Dict with available slots per date and cache metadata
+        Dict with available slots per date and cache metadata. When several
+        durations are requested, "slots_by_duration" holds one slot map per
+        duration and "slots" mirrors the first one.
     """
+    try:
+        durations = availability.parse_durations(duration)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid duration")
+    if slot_format not in availability.SLOT_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+    # Bounded range: keeps crawlers from sweeping the Google busy-time cache with huge spans
+    try:
+        range_days = (datetime.strptime(end_date, "%Y-%m-%d") - datetime.strptime(start_date, "%Y-%m-%d")).days + 1
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date")
+    if not 0 < range_days <= availability.MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range must be 1-{availability.MAX_RANGE_DAYS} days")
+
     # 1. Determine User Type (Public vs Friend)
     is_friend = False
     if token:
         is_friend = auth.verify_friend_token(token)
     
     hours = FRIEND_HOURS if is_friend else STANDARD_HOURS
-
-    # 2. Fetch ALL Sources of "Busy"
-    local_bookings = database.get_bookings_for_range(start_date, end_date)
-    local_blocks = database.get_blocks_for_range(start_date, end_date)
-    
-    # Pass force_refresh to calendar fetch
-    google_busy = gcal.get_google_busy_times(
-        start_date + "T00:00:00", 
-        end_date + "T23:59:59",
-        force_refresh=force_refresh
-    )
-    
-    occupied = local_bookings + local_blocks + google_busy
-    
-    results = {}
-    current = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
+    tier = "friend" if is_friend else "public"
     now_aest = datetime.now(AEST)
     
     # Public = 24 Hours Notice. Friends = 30 Minutes Notice.
     notice_buffer = timedelta(hours=24) if not is_friend else timedelta(minutes=30)
     earliest_booking_time = now_aest + notice_buffer
+    bucket = availability.earliest_bucket(earliest_booking_time)
 
-    while current <= end:
-        date_aest = AEST.localize(current)
-        date_str = date_aest.strftime("%Y-%m-%d")
-        
-        candidates = get_slots_for_day(date_aest, hours['start'], hours['end'], 15)
+    # 2. Serve straight from the computed-result cache where possible
+    generation = availability.current_generation()
+    results = {}
+    cache_timestamp = 0
+    if not force_refresh:
+        for d in durations:
+            hit = availability.get_cached_result(
+                availability.result_cache_key(start_date, end_date, d, tier, bucket)
+            )
+            if hit:
+                results[d], cache_timestamp = hit
+    missing = [d for d in durations if d not in results]
+
+    if missing:
+        # 3. Fetch ALL Sources of "Busy" (concurrently; cache-miss latency is the slowest source)
+        occupied = await fetch_occupied_async(start_date, end_date, force_refresh=force_refresh)
+
+        # 4. Rasterise busy time once, then fit every missing duration against it
+        computed = availability.compute_day_masks_multi(
+            start_date, end_date, missing, hours, earliest_booking_time, occupied
+        )
         
-        # Time Barrier & Notice Period Check
-        future_candidates = []
-        for s in candidates:
-            slot_dt = datetime.fromisoformat(s)
-            if slot_dt > earliest_booking_time:
-                future_candidates.append(s)
-
-        valid = [s for s in future_candidates if not is_overlapping(s, duration, occupied)]
-        results[date_str] = valid
-        current += timedelta(days=1)
-    
-    # Get cache timestamp for freshness indicator
-    cache_key_start = start_date + "T00:00:00"
-    cache_key_end = end_date + "T23:59:59"
-    cache_timestamp = gcal.get_cache_timestamp(cache_key_start, cache_key_end)
+        # Get cache timestamp for freshness indicator
+        cache_key_start = start_date + "T00:00:00"
+        cache_key_end = end_date + "T23:59:59"
+        cache_timestamp = gcal.get_cache_timestamp(cache_key_start, cache_key_end)
+
+        # Never outlive the Google data the result was built from
+        ttl = gcal.CACHE_DURATION
+        if cache_timestamp:
+            ttl = cache_timestamp + gcal.CACHE_DURATION - datetime.now().timestamp()
+        for d, day_masks in computed.items():
+            key = availability.result_cache_key(start_date, end_date, d, tier, bucket)
+            availability.cache_result(key, day_masks, cache_timestamp, ttl, generation)
+        results.update(computed)
+
+    # 5. Conditional GET: pollers whose data hasn't changed get a header-only reply
+    etag = availability.availability_etag(
+        {d: results[d] for d in durations}, start_date, end_date, slot_format
+    )
+    if availability.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     
-    return {
-        "slots": results,
+    slots = {d: availability.format_day_masks(results[d], slot_format) for d in durations}
+    body = {
+        "slots": slots[durations[0]],
         "cache_timestamp": cache_timestamp,
         "cache_age_seconds": int(datetime.now().timestamp() - cache_timestamp) if cache_timestamp else 0
     }
+    if len(durations) > 1:
+        body["slots_by_duration"] = {str(d): slots[d] for d in durations}
+    if slot_format != "iso":
+        body["format"] = slot_format
+        body["interval"] = availability.SLOT_INTERVAL
+        body["utc_offset"] = availability.utc_offset(start_date)
+    return body
+
+
+@app.get("/api/availability/next")
+def get_next_available(duration: int, count: int = 5, token: str = None):
+    """
+    Find the next N bookable slots, searching forward from the notice cutoff.
+    
+    Args:
+        duration: Meeting duration in minutes
+        count: How many slots to return (1-20)
+        token: Optional friend token for VIP access (extended hours, weekends, short notice)
+    
+    Returns:
+        Dict with the slots in time order and the last date that was searched
+    """
+    if not 1 <= count <= 20:
+        raise HTTPException(status_code=400, detail="count must be between 1 and 20")
+    if not availability.is_valid_duration(duration):
+        raise HTTPException(status_code=400, detail="Invalid duration")
+
+    is_friend = bool(token and auth.verify_friend_token(token))
+    hours = FRIEND_HOURS if is_friend else STANDARD_HOURS
+    notice_buffer = timedelta(hours=24) if not is_friend else timedelta(minutes=30)
+    earliest_booking_time = datetime.now(AEST) + notice_buffer
+
+    slots, searched_until = availability.find_next_slots(
+        count, duration, hours, earliest_booking_time, fetch_occupied,
+        include_weekends=is_friend
+    )
+    return {"slots": slots, "searched_until": searched_until}
 
 
 # ==========================================
@@ -334,7 +427,8 @@ async def calendar_webhook(
     x_goog_channel_id: Optional[str] = Header(None, alias="X-Goog-Channel-ID"),
     x_goog_resource_id: Optional[str] = Header(None, alias="X-Goog-Resource-ID"),
     x_goog_resource_state: Optional[str] = Header(None, alias="X-Goog-Resource-State"),
-    x_goog_message_number: Optional[str] = Header(None, alias="X-Goog-Message-Number")
+    x_goog_message_number: Optional[str] = Header(None, alias="X-Goog-Message-Number"),
+    x_goog_channel_token: Optional[str] = Header(None, alias="X-Goog-Channel-Token")
 ):
     """
     Webhook endpoint for Google Calendar push notifications.
@@ -342,12 +436,13 @@ async def calendar_webhook(
     """
     print(f"📬 Webhook received: channel={x_goog_channel_id}, state={x_goog_resource_state}, msg={x_goog_message_number}")
     
-    # Handle the webhook notification
+    # Schedule a debounced refresh of the changed calendar (the work happens off this request)
     if x_goog_channel_id and x_goog_resource_id:
         gcal.handle_webhook_notification(
             channel_id=x_goog_channel_id,
             resource_id=x_goog_resource_id,
-            resource_state=x_goog_resource_state or "unknown"
+            resource_state=x_goog_resource_state or "unknown",
+            token=x_goog_channel_token
         )
     
     # Always return 200 OK to acknowledge receipt
@@ -364,6 +459,12 @@ def force_calendar_refresh():
     return {"success": True, "message": "Calendar cache cleared"}
 
 
+@app.get("/api/admin/cache-stats")
+def get_cache_stats():
+    """Google busy-time cache size and hit/miss/eviction counters."""
+    return gcal.get_cache_stats()
+
+
 @app.patch("/api/admin/bookings/{booking_id}")
 def update_status(booking_id: int, update: StatusUpdate):
     database.update_booking_status(booking_id, update.status)
@@ -383,7 +484,44 @@ def update_status(booking_id: int, update: StatusUpdate):
     return {"success": True}
 
 @app.get("/api/admin/bookings")
-def get_bookings(): return database.get_all_bookings()
+def get_bookings(
+    status: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    fields: Optional[str] = None,
+    order: str = Query("asc", pattern="^(asc|desc)$")
+):
+    """
+    Page through bookings in (date, time, id) order.
+
+    Args:
+        status: Comma-separated statuses to include (e.g. "PENDING,ACCEPTED")
+        date_from / date_to: Inclusive YYYY-MM-DD bounds
+        cursor: "next_cursor" from the previous page
+        fields: Comma-separated columns to return (id, date and time are always included)
+        order: "asc" (oldest first) or "desc"
+
+    Returns:
+        {"bookings": [...], "next_cursor": str or None when this is the last page}
+    """
+    try:
+        rows, has_more = database.list_bookings(
+            statuses=[s.strip().upper() for s in status.split(",") if s.strip()] if status else None,
+            date_from=date_from,
+            date_to=date_to,
+            after=database.decode_cursor(cursor) if cursor else None,
+            limit=limit,
+            columns=[f.strip() for f in fields.split(",") if f.strip()] if fields else None,
+            descending=order == "desc",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "bookings": rows,
+        "next_cursor": database.encode_cursor(rows[-1]) if has_more else None,
+    }
 
 @app.get("/api/admin/blocks")
 def get_blocks(): return database.get_all_blocks()
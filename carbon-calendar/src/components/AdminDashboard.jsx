@@ -31,10 +31,33 @@ const AdminDashboard = () => {
     return () => clearInterval(interval);
   }, []);
 
+  // Follows next_cursor until every page of one /api/admin/bookings query is in
+  const fetchAllBookings = async (filters) => {
+    const params = new URLSearchParams({
+      ...filters,
+      fields: 'id,name,email,topic,date,time,duration,status',
+      limit: '500'
+    });
+    const rows = [];
+    let cursor = null;
+    do {
+      if (cursor) params.set('cursor', cursor);
+      const resBookings = await fetch(`${API_BASE_URL}/api/admin/bookings?${params}`);
+      const page = await resBookings.json();
+      rows.push(...page.bookings);
+      cursor = page.next_cursor;
+    } while (cursor);
+    return rows;
+  };
+
   const fetchData = async () => {
-    const resBookings = await fetch(`${API_BASE_URL}/api/admin/bookings`);
-    const dataBookings = await resBookings.json();
-    setBookings(dataBookings);
+    // Every PENDING request (even past-dated ones still need a decision) + ACCEPTED from today on
+    const today = new Date().toLocaleDateString('en-CA', { timeZone: 'Australia/Brisbane' });
+    const [pending, accepted] = await Promise.all([
+      fetchAllBookings({ status: 'PENDING' }),
+      fetchAllBookings({ status: 'ACCEPTED', date_from: today })
+    ]);
+    setBookings([...pending, ...accepted]);
 
     const resBlocks = await fetch(`${API_BASE_URL}/api/admin/blocks`);
     const dataBlocks = await resBlocks.json();
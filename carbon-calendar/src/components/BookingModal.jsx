@@ -3,6 +3,24 @@ import { useState, useEffect, useRef, useCallback } from 'react';
 import { API_BASE_URL } from '../config'; 
 
 const AUTO_REFRESH_INTERVAL = 30000; // 30 seconds
+const DURATION_OPTIONS = [15, 30, 60]; // Fetched together so toggling never refetches
+
+// Expand compact [start_minute, slot_count] runs into the ISO strings the grid renders
+const expandRuns = (runsByDate, interval, offset) => {
+  const pad = (n) => String(n).padStart(2, '0');
+  const slotsByDate = {};
+  Object.entries(runsByDate).forEach(([dateStr, runs]) => {
+    const slots = [];
+    runs.forEach(([start, count]) => {
+      for (let i = 0; i < count; i++) {
+        const mins = start + i * interval;
+        slots.push(`${dateStr}T${pad(Math.floor(mins / 60))}:${pad(mins % 60)}:00${offset}`);
+      }
+    });
+    slotsByDate[dateStr] = slots;
+  });
+  return slotsByDate;
+};
 
 const BookingModal = ({ isOpen, onClose }) => {
     if (!isOpen) return null;
@@ -11,7 +29,7 @@ const BookingModal = ({ isOpen, onClose }) => {
     const [step, setStep] = useState(1);
     const [duration, setDuration] = useState(30);
     const [weekOffset, setWeekOffset] = useState(0); 
-    const [availability, setAvailability] = useState({});
+    const [availabilityByDuration, setAvailabilityByDuration] = useState({});
     const [loading, setLoading] = useState(false);
     const [submitting, setSubmitting] = useState(false);
     const [friendToken, setFriendToken] = useState(null);
@@ -30,6 +48,7 @@ const BookingModal = ({ isOpen, onClose }) => {
     const [isRefreshing, setIsRefreshing] = useState(false);
     const [lastRefresh, setLastRefresh] = useState(null);
     const refreshIntervalRef = useRef(null);
+    const availability = availabilityByDuration[duration] || {};
   
   useEffect(() => {
     const params = new URLSearchParams(window.location.search);
@@ -102,16 +121,22 @@ const BookingModal = ({ isOpen, onClose }) => {
     if (!silent) setLoading(true);
     if (forceRefresh) setIsRefreshing(true);
     
-    let url = `${API_BASE_URL}/api/availability?start_date=${startStr}&end_date=${endStr}&duration=${duration}&mode=${mode}`;
+    let url = `${API_BASE_URL}/api/availability?start_date=${startStr}&end_date=${endStr}&duration=${DURATION_OPTIONS.join(',')}&mode=${mode}&format=compact`;
     if (friendToken) url += `&token=${friendToken}`;
     if (forceRefresh) url += `&force_refresh=true`;
 
     try {
         const res = await fetch(url);
         const data = await res.json();
-        // Handle both old format (direct slots) and new format (with slots property)
-        const slots = data.slots || data;
-        setAvailability(slots);
+        // One response carries every duration; fall back to the single-duration shapes
+        const raw = data.slots_by_duration || { [DURATION_OPTIONS[0]]: data.slots || data };
+        const byDuration = {};
+        Object.entries(raw).forEach(([mins, slots]) => {
+            byDuration[mins] = data.format === 'compact'
+                ? expandRuns(slots, data.interval, data.utc_offset)
+                : slots;
+        });
+        setAvailabilityByDuration(byDuration);
         setLastRefresh(new Date());
     } catch (err) {
         console.error('Failed to fetch availability:', err);
@@ -119,14 +144,14 @@ const BookingModal = ({ isOpen, onClose }) => {
         setLoading(false);
         setIsRefreshing(false);
     }
-  }, [currentWeekDates, customMode, duration, friendToken]);
+  }, [currentWeekDates, customMode, friendToken]);
 
   // Initial fetch when entering step 2
   useEffect(() => {
     if (step === 2) {
         fetchAvailability(false, false);
     }
-  }, [step, weekOffset, duration, customMode, friendToken]);
+  }, [step, weekOffset, customMode, friendToken]);
 
   // Auto-refresh polling when on step 2
   useEffect(() => {
@@ -185,6 +210,9 @@ const BookingModal = ({ isOpen, onClose }) => {
             alert("Request Sent Successfully.");
             onClose();
             setStep(1);
+        } else if (response.status === 409) {
+            alert("That time was just taken. Please pick another slot.");
+            setStep(1);
         } else {
             alert("Error sending request.");
         }
@@ -216,7 +244,7 @@ const BookingModal = ({ isOpen, onClose }) => {
             <div className="flex flex-col items-center justify-center h-full space-y-8 py-10">
                 <h3 className="text-xl md:text-2xl font-bold text-white text-center">Select Duration</h3>
                 <div className="grid grid-cols-1 md:grid-cols-3 gap-4 md:gap-6 w-full max-w-2xl">
-                    {[15, 30, 60].map(mins => (
+                    {DURATION_OPTIONS.map(mins => (
                         <button 
                             key={mins}
                             onClick={() => { setDuration(mins); setStep(2); }}
@@ -1,15 +1,18 @@
 import os
+import sys
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from backend.gcal import get_service, fetch_events_from_calendar
+
+# gcal imports its backend siblings (availability, database) as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+from backend.gcal import (
+    get_service, get_calendar_ids, fetch_events_from_calendar,
+    buffer_reasons, BUFFER_KEYWORDS, BUFFER_COLOR_IDS, BUFFER_MINUTES,
+)
 
 # Load your configuration
 load_dotenv("backend/.env")
 
-UQ_IDS = os.getenv("EXTRA_CALENDAR_IDS", "").split(",")
-KEYWORDS = os.getenv("BUFFER_KEYWORDS", "").lower().split(",")
-COLORS = os.getenv("BUFFER_COLOR_IDS", "").split(",")
-
 def scan_tomorrow():
     service = get_service()
     if not service:
@@ -22,12 +25,12 @@ def scan_tomorrow():
     t_end = tomorrow.replace(hour=23, minute=59, second=59).isoformat() + "Z"
     
     print(f"\n🔎 SCANNING FOR: {tomorrow.strftime('%Y-%m-%d')}")
-    print(f"🎯 Keywords: {KEYWORDS}")
-    print(f"🎨 Color IDs: {COLORS}")
+    print(f"🎯 Keywords: {BUFFER_KEYWORDS}")
+    print(f"🎨 Color IDs: {BUFFER_COLOR_IDS}")
     print("-" * 50)
 
     # List of calendars to check
-    calendars = ['primary'] + [c.strip() for c in UQ_IDS if c.strip()]
+    calendars = get_calendar_ids()
 
     total_events = 0
 
@@ -42,27 +45,17 @@ def scan_tomorrow():
         for event in events:
             total_events += 1
             summary = event.get('summary', 'No Title')
-            color = event.get('colorId', 'None')
+            color = event.get('colorId', '')
             start = event['start'].get('dateTime', event['start'].get('date'))
             
-            # CHECK LOGIC
-            is_hit = False
-            reason = []
-            
-            # Check Keyword
-            for word in KEYWORDS:
-                if word in summary.lower():
-                    is_hit = True
-                    reason.append(f"Keyword match: '{word}'")
-            
-            # Check Color
-            if color in COLORS:
-                is_hit = True
-                reason.append(f"Color match: ID {color}")
+            # CHECK LOGIC (the exact classifier gcal uses)
+            reason = buffer_reasons(event.get('summary', ''), color)
+            is_hit = bool(reason)
 
             # PRINT RESULT
-            status = "🛡️ BLOCKED (+1hr Buffer)" if is_hit else "✅ FREE (Ignored)"
-            print(f"   • [{start[11:16]}] {summary} (Color: {color})")
+            # Every event blocks its own time; buffered ones also block BUFFER_MINUTES either side
+            status = f"🛡️ BLOCKED (+{BUFFER_MINUTES} min Buffer)" if is_hit else "⏺️ BLOCKED (No Buffer)"
+            print(f"   • [{start[11:16]}] {summary} (Color: {color or 'None'})")
             print(f"     -> STATUS: {status}")
             if is_hit:
                 print(f"     -> REASON: {', '.join(reason)}")